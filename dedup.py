@@ -3,45 +3,399 @@ import os
 import hashlib
 import argparse
 import json
+import time
+import signal
+import shutil
+import re
+import fnmatch
+import functools
+import queue
+import threading
+import itertools
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-def chunk_reader(fobj, chunk_size=1024):
-    """Generator that reads a file in chunks of bytes"""
-    while True:
-        chunk = fobj.read(chunk_size)
-        if not chunk:
-            return
-        yield chunk
+from filehash import hash_file, files_identical, format_duration, ordered_pool_map, HASH_ALGORITHMS, DEFAULT_HASH
+from hashindex import HashIndex
+
+# Digest fields stored in the per-directory hash record (hex on disk, bytes in memory)
+HASH_FIELDS = ("hash", "partial_hash")
+
+# ioctl from linux/fs.h: share the source file's extents with the destination (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Per-candidate status byte in a CandidateTable: the low two bits say whether
+# the file's stored record still describes it, the rest which digests are known
+REC_OK, REC_MISSING, REC_SIZE_CHANGED, REC_MTIME_CHANGED = range(4)
+REC_MASK = 0x03
+HAS_HASH = 0x04
+HAS_PARTIAL = 0x08
+PARTIAL_SPEC_CHANGED = 0x10
+ALGORITHM_CHANGED = 0x20
+REC_REASONS = {
+    REC_MISSING: "not in database",
+    REC_SIZE_CHANGED: "size changed",
+    REC_MTIME_CHANGED: "mtime changed",
+}
+
+def whole_seconds(mtime_ns):
+    """int(st_mtime) for a given st_mtime_ns, computed the same way CPython builds st_mtime"""
+    sec, nsec = divmod(mtime_ns, 1_000_000_000)
+    return int(sec + nsec * 1e-9)
+
+class Candidate:
+    """One file found by the walk that is big enough to be considered"""
+    __slots__ = ("dirpath", "filename", "size", "mtime_ns", "dev", "ino")
+
+    def __init__(self, dirpath, filename, size, mtime_ns, dev, ino):
+        self.dirpath = dirpath
+        self.filename = filename
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.dev = dev
+        self.ino = ino
+
+    @property
+    def full_path(self):
+        return os.path.join(self.dirpath, self.filename)
+
+class CandidateTable:
+    """Every candidate of a run in typed columns, about 100 bytes per file plus its name"""
+    def __init__(self, algorithm, digest_size, partial_spec=None):
+        self.algorithm = algorithm
+        self.digest_size = digest_size
+        self.partial_spec = partial_spec
+        self.dirs = []
+        self.dir_lookup = {}
+        self.dir_ids = array("I")
+        self.names = []
+        self.sizes = array("Q")
+        self.mtimes_ns = array("q")
+        self.devs = array("Q")
+        self.inos = array("Q")
+        self.status = bytearray()
+        self.hashes = bytearray()
+        self.partial_hashes = bytearray()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        return Candidate(
+            self.dirs[self.dir_ids[idx]], self.names[idx], self.sizes[idx],
+            self.mtimes_ns[idx], self.devs[idx], self.inos[idx]
+        )
+
+    def dir_id(self, dirpath):
+        """Id of an interned directory path"""
+        dir_id = self.dir_lookup.get(dirpath)
+        if dir_id is None:
+            dir_id = self.dir_lookup[dirpath] = len(self.dirs)
+            self.dirs.append(dirpath)
+        return dir_id
+
+    def append(self, dir_id, filename, stat, rec=None):
+        """Add a file, taking whatever digests are still valid from its stored record entry"""
+        empty = bytes(self.digest_size)
+        status = REC_MISSING
+        file_hash = partial_hash = empty
+        if rec is not None:
+            if rec.get("size") != stat.st_size:
+                status = REC_SIZE_CHANGED
+            elif rec.get("mtime") != whole_seconds(stat.st_mtime_ns) or rec.get("mtime_ns", stat.st_mtime_ns) != stat.st_mtime_ns:
+                # Older records only have whole-second mtimes
+                status = REC_MTIME_CHANGED
+            elif rec.get("algorithm", DEFAULT_HASH) != self.algorithm:
+                status = REC_OK | ALGORITHM_CHANGED
+            else:
+                status = REC_OK
+                if len(rec.get("hash") or b"") == self.digest_size:
+                    status |= HAS_HASH
+                    file_hash = rec["hash"]
+                if len(rec.get("partial_hash") or b"") == self.digest_size:
+                    if rec.get("partial_spec") == self.partial_spec:
+                        status |= HAS_PARTIAL
+                        partial_hash = rec["partial_hash"]
+                    else:
+                        status |= PARTIAL_SPEC_CHANGED
+        self.dir_ids.append(dir_id)
+        self.names.append(filename)
+        self.sizes.append(stat.st_size)
+        self.mtimes_ns.append(stat.st_mtime_ns)
+        self.devs.append(stat.st_dev)
+        self.inos.append(stat.st_ino)
+        self.status.append(status)
+        self.hashes += file_hash
+        self.partial_hashes += partial_hash
+
+    def reason(self, idx, field="hash"):
+        """Why the stored digest for field can't be used, or None if it can"""
+        status = self.status[idx]
+        if status & REC_MASK != REC_OK:
+            return REC_REASONS[status & REC_MASK]
+        if status & ALGORITHM_CHANGED:
+            return "hash algorithm changed"
+        if field == "hash":
+            return None if status & HAS_HASH else "hash missing"
+        if status & HAS_PARTIAL:
+            return None
+        return "partial sample changed" if status & PARTIAL_SPEC_CHANGED else "partial hash missing"
+
+    def digest(self, idx, field="hash"):
+        """The known digest for field, or None"""
+        if not self.status[idx] & (HAS_HASH if field == "hash" else HAS_PARTIAL):
+            return None
+        column = self.hashes if field == "hash" else self.partial_hashes
+        return bytes(column[idx * self.digest_size:(idx + 1) * self.digest_size])
+
+    def set_digest(self, idx, field, digest):
+        """Store a freshly computed digest; the file's record is now current"""
+        if self.status[idx] & REC_MASK != REC_OK or self.status[idx] & ALGORITHM_CHANGED:
+            # Any digests from the stale record no longer apply
+            self.status[idx] = REC_OK
+        column = self.hashes if field == "hash" else self.partial_hashes
+        column[idx * self.digest_size:(idx + 1) * self.digest_size] = digest
+        self.status[idx] |= HAS_HASH if field == "hash" else HAS_PARTIAL
+        if field == "partial_hash":
+            self.status[idx] &= ~PARTIAL_SPEC_CHANGED
+
+    def record(self, idx):
+        """The record entry to store for a file: mtime, size and whatever digests are known"""
+        mtime_ns = self.mtimes_ns[idx]
+        rec = {"mtime": whole_seconds(mtime_ns), "mtime_ns": mtime_ns, "size": self.sizes[idx]}
+        if self.status[idx] & (HAS_HASH | HAS_PARTIAL):
+            rec["algorithm"] = self.algorithm
+        if self.status[idx] & REC_MASK == REC_OK:
+            if self.status[idx] & HAS_HASH:
+                rec["hash"] = self.digest(idx, "hash")
+            if self.status[idx] & HAS_PARTIAL:
+                rec["partial_hash"] = self.digest(idx, "partial_hash")
+                rec["partial_spec"] = self.partial_spec
+        return rec
+
+def format_bytes(num):
+    """Format a byte count for humans, e.g. 1536 -> '1.5 KiB'"""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num < 1024:
+            return f"{num:.1f} {unit}"
+        num /= 1024
+    return f"{num:.1f} TiB"
+
+class PrecedenceRules:
+    """Precedence rules compiled once for matching against many paths.
+
+    Prefix rules are matched by path component through a trie. Glob rules
+    must match the whole normalized path; regex rules match anywhere in it.
+    """
+    def __init__(self, rules):
+        self.rules = []
+        self.trie = {}  # component -> child node; node["\0"] = {"keep": [...], "delete": [...]}
+        self.patterns = []  # (rule index, side, match or search method of the compiled pattern)
+        for rule in rules:
+            if not isinstance(rule, dict) or not rule.get("keep") or not rule.get("delete"):
+                continue
+            idx = len(self.rules)
+            self.rules.append(rule)
+            rule_type = rule.get("type", "prefix")
+            for side in ("keep", "delete"):
+                if rule_type == "prefix":
+                    node = self.trie
+                    for part in self._parts(rule[side]):
+                        node = node.setdefault(part, {})
+                    node.setdefault("\0", {"keep": [], "delete": []})[side].append(idx)
+                elif rule_type == "glob":
+                    self.patterns.append((idx, side, re.compile(fnmatch.translate(os.path.normpath(rule[side]))).match))
+                elif rule_type == "regex":
+                    self.patterns.append((idx, side, re.compile(rule[side]).search))
+                else:
+                    print(f"Ignoring precedence rule with unknown type {rule_type!r}: {rule}")
+                    self.rules[idx] = None
+                    break
+        self.classify = functools.lru_cache(maxsize=65536)(self._classify)
+
+    def __len__(self):
+        return sum(1 for rule in self.rules if rule is not None)
+
+    @staticmethod
+    def _parts(path):
+        parts = os.path.normpath(path).split(os.sep)
+        if len(parts) > 1 and parts[-1] == "":
+            parts.pop()  # the root directory
+        return parts
+
+    def _classify(self, path):
+        """Return (keep rule indices, delete rule indices) that match path"""
+        keep, delete = set(), set()
+        node = self.trie
+        for part in [None] + self._parts(path):
+            if part is not None:
+                node = node.get(part)
+                if node is None:
+                    break
+            ends = node.get("\0")
+            if ends:
+                keep.update(ends["keep"])
+                delete.update(ends["delete"])
+        if self.patterns:
+            normalized = os.path.normpath(path)
+            for idx, side, matches in self.patterns:
+                if self.rules[idx] is not None and matches(normalized):
+                    (keep if side == "keep" else delete).add(idx)
+        return frozenset(keep), frozenset(delete)
+
+    def match(self, path1, path2):
+        """Returns (keep_path, delete_path, rule) for the first rule that matches, else (None, None, None)"""
+        keep1, delete1 = self.classify(path1)
+        keep2, delete2 = self.classify(path2)
+        forward = keep1 & delete2
+        backward = keep2 & delete1
+        if not forward and not backward:
+            return (None, None, None)
+        idx = min(forward | backward)
+        if idx in forward:
+            return (path1, path2, self.rules[idx])
+        return (path2, path1, self.rules[idx])
 
 def load_precedence_rules(path):
     if not path:
-        return []
+        return PrecedenceRules([])
     try:
         with open(path, "r") as f:
             rules = json.load(f)
             # Each rule should be a dict with 'keep' and 'delete' keys
-            return rules if isinstance(rules, list) else []
+            return PrecedenceRules(rules if isinstance(rules, list) else [])
     except Exception as e:
         print(f"Could not load precedence rules: {e}")
-        return []
+        return PrecedenceRules([])
 
 def match_precedence_rule(rules, path1, path2):
     # Returns (keep_path, delete_path, rule) if a rule matches, else (None, None, None)
-    for rule in rules:
-        keep_prefix = rule.get("keep")
-        delete_prefix = rule.get("delete")
-        if keep_prefix and delete_prefix:
-            # Normalize for OS
-            kp = os.path.normpath(keep_prefix)
-            dp = os.path.normpath(delete_prefix)
-            p1 = os.path.normpath(path1)
-            p2 = os.path.normpath(path2)
-            if p1.startswith(kp) and p2.startswith(dp):
-                return (path1, path2, rule)
-            if p2.startswith(kp) and p1.startswith(dp):
-                return (path2, path1, rule)
-    return (None, None, None)
-
-def load_dir_hash_record(dirpath, record_name):
+    if not isinstance(rules, PrecedenceRules):
+        rules = PrecedenceRules(rules)
+    return rules.match(path1, path2)
+
+def path_depth(path):
+    return os.path.normpath(path).count(os.sep)
+
+# Criteria for --keep-order; lower key wins
+KEEP_CRITERIA = {
+    "oldest": lambda c: c.mtime_ns,
+    "newest": lambda c: -c.mtime_ns,
+    "shallowest": lambda c: path_depth(c.full_path),
+    "deepest": lambda c: -path_depth(c.full_path),
+    "shortest": lambda c: len(c.full_path),
+    "longest": lambda c: -len(c.full_path),
+}
+DEFAULT_KEEP_ORDER = ("oldest", "shallowest")
+
+def parse_keep_order(value):
+    order = tuple(name.strip() for name in value.split(",") if name.strip())
+    unknown = [name for name in order if name not in KEEP_CRITERIA]
+    if unknown or not order:
+        raise argparse.ArgumentTypeError(
+            f"invalid keep order {value!r}, choose from {', '.join(KEEP_CRITERIA)}"
+        )
+    return order
+
+def precedence_losers(members, rules):
+    """Return {full_path: rule} for members a precedence rule says to delete in favour of another member"""
+    losers = {}
+    if rules:
+        for a in members:
+            for b in members:
+                if a is not b:
+                    keep, to_delete, rule = match_precedence_rule(rules, a.full_path, b.full_path)
+                    if to_delete == b.full_path:
+                        losers[b.full_path] = rule
+    return losers
+
+def rank_keeper(members, keep_order=DEFAULT_KEEP_ORDER):
+    """Best member by keep_order, then by path so the choice is reproducible"""
+    return min(members, key=lambda c: tuple(KEEP_CRITERIA[name](c) for name in keep_order) + (c.full_path,))
+
+def suggest_keeper(members, rules=None, keep_order=DEFAULT_KEEP_ORDER):
+    """Pick which of a group of identical Candidates to keep. Returns (keeper, reason).
+
+    Members that lose to another under a precedence rule are ruled out
+    first, and keep_order ranks whatever is left.
+    """
+    losers = precedence_losers(members, rules)
+    remaining = [c for c in members if c.full_path not in losers] or list(members)
+    keeper = rank_keeper(remaining, keep_order)
+    if len(remaining) == 1 and losers:
+        return keeper, f"precedence rule {losers[next(c.full_path for c in members if c is not keeper)]}"
+    return keeper, f"keep order {','.join(keep_order)}"
+
+def scan_tree(root, ignore_names=(), excludes=(), one_file_system=False, jobs=1):
+    """Walk root top-down like os.walk, yielding (dirpath, [(filename, stat_result)]).
+
+    Built on os.scandir so directory entries' cached type and stat data are
+    reused instead of stat-ing every path again. Names in ignore_names and
+    entries matching an exclude glob (on the name or the full path) are
+    dropped before any stat call. Only regular files are returned; symlinks,
+    to files or directories, are skipped. With one_file_system, directories
+    on another device than root are skipped.
+
+    With jobs > 1, directories are listed in a thread pool as soon as they
+    are discovered, which hides latency on network filesystems. Results are
+    still yielded in the same order as a serial walk.
+    """
+    exclude_re = None
+    if excludes:
+        exclude_re = re.compile("|".join(fnmatch.translate(pattern) for pattern in excludes))
+    try:
+        root_dev = os.stat(root).st_dev if one_file_system else None
+    except OSError as e:
+        print(f"Could not stat directory {root}: {e}")
+        return
+
+    def list_dir(dirpath):
+        files = []
+        subdirs = []
+        try:
+            it = os.scandir(dirpath)
+        except OSError as e:
+            print(f"Could not list directory {dirpath}: {e}")
+            return files, subdirs
+        with it:
+            for entry in it:
+                if entry.name in ignore_names:
+                    continue
+                if exclude_re and (exclude_re.match(entry.name) or exclude_re.match(entry.path)):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if root_dev is None or entry.stat(follow_symlinks=False).st_dev == root_dev:
+                            subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry.name, entry.stat(follow_symlinks=False)))
+                except OSError as e:
+                    print(f"Could not stat file {entry.path}: {e}")
+        return files, subdirs
+
+    if jobs <= 1:
+        stack = [root]
+        while stack:
+            dirpath = stack.pop()
+            files, subdirs = list_dir(dirpath)
+            yield dirpath, files
+            stack.extend(reversed(subdirs))
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        stack = [(root, executor.submit(list_dir, root))]
+        while stack:
+            dirpath, future = stack.pop()
+            files, subdirs = future.result()
+            yield dirpath, files
+            stack.extend(reversed([(d, executor.submit(list_dir, d)) for d in subdirs]))
+
+def load_dir_hash_record(dirpath, record_name, verbose=True):
     record_path = os.path.join(dirpath, record_name)
     if os.path.exists(record_path):
         try:
@@ -49,72 +403,505 @@ def load_dir_hash_record(dirpath, record_name):
                 record = json.load(f)
             # Convert any hex string hashes back to bytes
             for fname, meta in record.items():
-                if "hash" in meta and isinstance(meta["hash"], str):
-                    try:
-                        meta["hash"] = bytes.fromhex(meta["hash"])
-                    except Exception:
-                        pass
-            print(f"Loaded hash record from {record_path}")
+                for field in HASH_FIELDS:
+                    if field in meta and isinstance(meta[field], str):
+                        try:
+                            meta[field] = bytes.fromhex(meta[field])
+                        except Exception:
+                            pass
+            if verbose:
+                print(f"Loaded hash record from {record_path}")
             return record
         except Exception as e:
             print(f"Could not load hash record {record_path}: {e}")
-    print(f"Creating new hash record for {dirpath}")
+    if verbose:
+        print(f"Creating new hash record for {dirpath}")
     return {}
 
-def save_dir_hash_record(dirpath, record_name, record):
+def save_dir_hash_record(dirpath, record_name, record, verbose=True):
     record_path = os.path.join(dirpath, record_name)
-    # Convert any bytes in 'hash' fields to hex strings for JSON serialization
+    # Convert any bytes in hash fields to hex strings for JSON serialization
     serializable_record = {}
     for fname, meta in record.items():
         meta_copy = dict(meta)
-        if isinstance(meta_copy.get("hash"), bytes):
-            meta_copy["hash"] = meta_copy["hash"].hex()
+        for field in HASH_FIELDS:
+            if isinstance(meta_copy.get(field), bytes):
+                meta_copy[field] = meta_copy[field].hex()
         serializable_record[fname] = meta_copy
+    # Write to a temp file and rename over the record, so a crash mid-write
+    # leaves the previous record intact instead of a truncated one
+    tmp_path = record_path + ".tmp"
     try:
-        with open(record_path, "w") as f:
+        with open(tmp_path, "w") as f:
             json.dump(serializable_record, f, indent=2, sort_keys=True)
-        print(f"Saved hash record to {record_path}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, record_path)
+        if verbose:
+            print(f"Saved hash record to {record_path}")
     except Exception as e:
         print(f"Could not save hash record {record_path}: {e}")
 
-def get_file_hash(full_path, hashfunc, mtime, size, dir_record, filename, dirpath=None, record_name=None, record_hashes=False):
-    rec = dir_record.get(filename)
-    reason = None
-    if rec is None:
-        reason = "not in database"
-    elif rec.get("mtime") != mtime:
-        reason = "mtime changed"
-    elif rec.get("size") != size:
-        reason = "size changed"
-    elif "hash" not in rec:
-        reason = "hash missing"
-    if reason:
-        print(f"{reason} -> Computing hash for {full_path}")
-        hashobj = hashfunc()
-        with open(full_path, 'rb') as f:
-            for chunk in chunk_reader(f):
-                hashobj.update(chunk)
-        file_hash = hashobj.digest()
-        # Update record
-        dir_record[filename] = {"mtime": mtime, "size": size, "hash": file_hash}
-        # Write out the updated dir_record immediately after getting a new hash if requested
-        if record_hashes and dirpath and record_name:
-            save_dir_hash_record(dirpath, record_name, dir_record)
-        return file_hash
-    else:
-        print(f"Using cached hash for {full_path}")
-        return rec["hash"]
+class RecordCheckpointer:
+    """Queues per-directory hash record entries and saves them every_files entries or every_seconds"""
+    def __init__(self, record_name, every_files=100, every_seconds=30.0, verbose=True):
+        self.record_name = record_name
+        self.every_files = every_files
+        self.every_seconds = every_seconds
+        self.verbose = verbose
+        self.pending = defaultdict(dict)  # dirpath -> {filename: record entry}
+        self.unsaved = 0
+        self.last_flush = time.monotonic()
+
+    def mark(self, dirpath, filename, rec):
+        self.pending[dirpath][filename] = rec
+        self.unsaved += 1
+        if self.unsaved >= self.every_files or time.monotonic() - self.last_flush >= self.every_seconds:
+            self.flush()
+
+    def flush(self):
+        for dirpath in sorted(self.pending):
+            record = load_dir_hash_record(dirpath, self.record_name, verbose=False)
+            record.update(self.pending[dirpath])
+            save_dir_hash_record(dirpath, self.record_name, record, self.verbose)
+        self.pending.clear()
+        self.unsaved = 0
+        self.last_flush = time.monotonic()
+
+def partial_hash_offsets(size, sample_size, middle_samples=0):
+    """Offsets of the head, evenly spaced middle and tail blocks sampled for a partial hash"""
+    offsets = [0]
+    for i in range(1, middle_samples + 1):
+        offsets.append(size * i // (middle_samples + 1) - sample_size // 2)
+    offsets.append(size - sample_size)
+    return offsets
+
+def compute_partial_hash(full_path, hashfunc, size, sample_size, middle_samples=0):
+    """Cheap digest of the first and last sample_size bytes (plus optional middle blocks)"""
+    hashobj = hashfunc()
+    with open(full_path, 'rb') as f:
+        for offset in partial_hash_offsets(size, sample_size, middle_samples):
+            f.seek(offset)
+            hashobj.update(f.read(sample_size))
+    return hashobj.digest()
+
+def compute_file_hash(full_path, hashfunc, use_mmap=False):
+    return hash_file(full_path, hashfunc, use_mmap=use_mmap).digest()
+
+class Progress:
+    """Per-stage counters and timings, a status line on stderr and the --stats-json summary"""
+    def __init__(self, every_seconds=5.0, show=False):
+        self.every_seconds = every_seconds
+        self.show = show
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.stages = {}
+        self.name = None
+        self.stage = None
+        self.stage_started = None
+        self.results = {}
+        self.completed = False
+
+    def start_stage(self, name, **totals):
+        self.end_stage()
+        self.name = name
+        self.stage = self.stages[name] = defaultdict(int, totals)
+        self.stage_started = time.monotonic()
+
+    def end_stage(self):
+        if self.stage is not None:
+            self.stage["seconds"] = round(time.monotonic() - self.stage_started, 3)
+            if self.show:
+                self.report()
+            self.stage = None
+
+    def add(self, **counts):
+        for key, n in counts.items():
+            self.stage[key] += n
+        if self.show and time.monotonic() - self.last_report >= self.every_seconds:
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        self.last_report = now
+        s = self.stage
+        elapsed = max(now - self.stage_started, 1e-6)
+        if self.name == "walk":
+            line = f"{s['dirs']} dirs, {s['files']} files, {s['files'] / elapsed:.0f} files/s"
+        elif "total_bytes" in s:
+            rate = s["bytes_read"] / elapsed
+            line = (
+                f"{s['cached'] + s['computed'] + s['errors']}/{s['total_files']} files, "
+                f"{format_bytes(s['bytes_read'])}/{format_bytes(s['total_bytes'])}, "
+                f"{s['computed'] / elapsed:.0f} files/s, {rate / 1e6:.1f} MB/s, "
+                f"{s['cached']} cached, {s['computed']} computed"
+            )
+            if s["bytes_read"] < s["total_bytes"] and rate > 0:
+                line += f", ETA {format_duration((s['total_bytes'] - s['bytes_read']) / rate)}"
+        else:
+            line = ", ".join(f"{n} {key}" for key, n in s.items() if key != "seconds")
+        print(f"[{self.name} {format_duration(now - self.started)}] {line}", file=sys.stderr, flush=True)
+
+    def summary(self):
+        self.end_stage()
+        return {
+            "started_at": self.started_at,
+            "seconds": round(time.monotonic() - self.started, 3),
+            "completed": self.completed,
+            "stages": {name: dict(counts) for name, counts in self.stages.items()},
+            **self.results
+        }
+
+    def write_json(self, path):
+        try:
+            with open(path, "w") as f:
+                json.dump(self.summary(), f, indent=2)
+                f.write("\n")
+        except OSError as e:
+            print(f"Could not write stats to {path}: {e}", file=sys.stderr)
+
+def hash_candidates(table, indices, field, compute, jobs=1, checkpoint=None, index=None, progress=None, read_size=None, verbose=True):
+    """Make sure the digest stored under `field` is known for table[indices].
+
+    Only compute(full_path, size) runs in the worker pool. Cache checks,
+    table updates and record writes all happen on the calling thread in
+    input order, so the outcome is the same as a serial run. New digests go
+    to the SQLite index when one is given, else to the per-directory record
+    through the checkpointer. Files that can't be read are left without one.
+    read_size(size) is how many bytes compute reads, for progress reporting.
+    """
+    label = field.replace("_", " ")
+    progress = progress or Progress()
+    read_size = read_size or (lambda size: size)
+    pending = []
+    cached = 0
+    total_bytes = 0
+    for idx in indices:
+        reason = table.reason(idx, field)
+        if reason:
+            pending.append((idx, reason))
+            total_bytes += read_size(table.sizes[idx])
+        else:
+            cached += 1
+            if verbose:
+                print(f"Using cached {label} for {table[idx].full_path}")
+    progress.start_stage(field, total_files=len(indices), total_bytes=total_bytes)
+    progress.add(cached=cached)
+
+    def work(item):
+        c = table[item[0]]
+        try:
+            return compute(c.full_path, c.size), None
+        except OSError as e:
+            return None, e
+
+    for (idx, reason), (digest, error) in zip(pending, ordered_pool_map(work, pending, jobs)):
+        c = table[idx]
+        if error:
+            print(f"Could not read file {c.full_path}: {error}")
+            progress.add(errors=1)
+            continue
+        if verbose:
+            print(f"{reason} -> Computed {label} for {c.full_path}")
+        progress.add(computed=1, bytes_read=read_size(c.size))
+        table.set_digest(idx, field, digest)
+        if index:
+            # Batched into transactions by the index
+            index.put(c.dirpath, c.filename, c.dev, c.ino, table.record(idx))
+        elif checkpoint:
+            checkpoint.mark(c.dirpath, c.filename, table.record(idx))
+
+def reflink_file(src, dst):
+    """Create dst, which must not exist, as a copy-on-write clone of src. Raises OSError where unsupported."""
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            os.remove(dst)
+            raise
 
-def log_deletion(logfile, deleted, kept, reason):
+def remove_duplicate(to_delete, keep, link=None):
+    """Delete to_delete, or with link="hardlink"/"reflink" replace it with a link to keep.
+
+    The link is made under a temp name and renamed over to_delete, so the
+    path never goes missing. If linking fails (e.g. across filesystems) the
+    duplicate is left untouched and OSError is raised.
+    """
+    if not link:
+        os.remove(to_delete)
+        return
+    # Never reuse a name that exists, e.g. one left behind by a crashed run
+    for n in itertools.count():
+        tmp_path = f"{to_delete}.dedup-link{n or ''}.tmp"
+        try:
+            if link == "hardlink":
+                os.link(keep, tmp_path)
+            else:
+                reflink_file(keep, tmp_path)
+            break
+        except FileExistsError:
+            continue
     try:
-        with open(logfile, "a") as f:
+        if link != "hardlink":
+            # A reflink is its own inode, so keep the duplicate's own metadata
+            shutil.copystat(to_delete, tmp_path)
+        os.replace(tmp_path, to_delete)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+class Remover:
+    """Deletes or links duplicates on a background thread, logging each one in fsync'ed batches"""
+    def __init__(self, log_file=None, link=None, verify=False, batch_size=64, flush_seconds=1.0):
+        self.link = link
+        self.verify = verify
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.removed = self.removed_bytes = self.skipped = self.failed = 0
+        self.error = None
+        self.log_file = log_file
+        self.log = None
+        if log_file:
+            try:
+                self.log = open(log_file, "a")
+            except OSError as e:
+                print(f"Could not open log file {log_file}: {e}", file=sys.stderr)
+        # Bounded, so a run far ahead of the disk waits instead of piling up work
+        self.queue = queue.Queue(maxsize=256)
+        self.thread = threading.Thread(target=self._run, name="dedup-remover", daemon=True)
+        self.thread.start()
+
+    def submit(self, path, keep, reason, size=0):
+        self._check()
+        self.queue.put((path, keep, reason, size))
+
+    def drain(self):
+        """Wait until everything submitted so far is removed and reported"""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.log:
+            self.log.close()
+        self._check()
+
+    def _check(self):
+        # Raise whatever stopped the worker here, on the caller's thread
+        if self.error is not None:
+            raise self.error
+
+    def _remove(self, path, keep):
+        """Remove one duplicate; returns True, or False if it was left in place"""
+        try:
+            if self.verify and not files_identical(path, keep):
+                print(f"Contents differ despite matching hashes, keeping: {path}")
+                self.skipped += 1
+                return False
+            remove_duplicate(path, keep, self.link)
+        except OSError as e:
+            print(f"Could not remove {path}: {e}")
+            self.failed += 1
+            return False
+        return True
+
+    def _commit(self, done):
+        """Make the log lines for a batch of removals durable, then report them"""
+        if self.log and done:
+            try:
+                for path, keep, reason, size in done:
+                    self.log.write(json.dumps({
+                        "deleted": path,
+                        "kept": keep,
+                        "reason": reason,
+                        "action": self.link or "delete"
+                    }) + "\n")
+                self.log.flush()
+                os.fsync(self.log.fileno())
+            except OSError as e:
+                print(f"Could not write to log file {self.log_file}: {e}", file=sys.stderr)
+        for path, keep, reason, size in done:
+            print(f"{'Linked' if self.link else 'Deleted'}: {path} ({reason})")
+            self.removed += 1
+            self.removed_bytes += size
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            started = time.monotonic()
+            taken = 1
+            done = []
+            try:
+                while job is not None and self.error is None:
+                    path, keep, reason, size = job
+                    if self._remove(path, keep):
+                        done.append(job)
+                    if len(done) >= self.batch_size or time.monotonic() - started >= self.flush_seconds:
+                        break
+                    try:
+                        job = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    taken += 1
+                self._commit(done)
+            except Exception as e:
+                # Nothing more is removed; the queue still drains so callers never block
+                self.error = e
+            finally:
+                for _ in range(taken):
+                    self.queue.task_done()
+            if job is None:
+                return
+
+def write_plan(plan_file, groups, rules=None, keep_order=DEFAULT_KEEP_ORDER, algorithm=DEFAULT_HASH):
+    """Write one JSON line per duplicate group with a suggested keeper.
+
+    Each line has the shared hash, its algorithm and size, the file to keep, the files to
+    delete and every member's mtime_ns, so apply_plan can skip files that
+    changed after the scan. Lines can be edited or removed before applying.
+    """
+    reclaimable = 0
+    with open(plan_file, "w") as f:
+        for (file_hash, size), members in groups:
+            keeper, reason = suggest_keeper(members, rules, keep_order)
             f.write(json.dumps({
-                "deleted": deleted,
-                "kept": kept,
-                "reason": reason
+                "hash": file_hash.hex(),
+                "algorithm": algorithm,
+                "size": size,
+                "keep": keeper.full_path,
+                "delete": [c.full_path for c in members if c is not keeper],
+                "reason": reason,
+                "mtime_ns": {c.full_path: c.mtime_ns for c in members}
             }) + "\n")
-    except Exception as e:
-        print(f"Could not write to log file {logfile}: {e}", file=sys.stderr)
+            reclaimable += size * (len(members) - 1)
+    print(f"\nWrote {len(groups)} duplicate groups to {plan_file}, {format_bytes(reclaimable)} reclaimable")
+
+def apply_plan(plan_file, delete=False, link=None, log_file=None, verify=False):
+    """Carry out a plan written by write_plan; without delete, only report what would happen.
+
+    Removals run on a Remover. With verify, each file is compared byte for
+    byte with the keeper before it is removed.
+    """
+    remover = Remover(log_file, link, verify) if delete else None
+    groups = removed = skipped = failed = 0
+    reclaimed = 0
+    with open(plan_file, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                group = json.loads(line)
+                keep, size = group["keep"], group["size"]
+                to_delete = group["delete"]
+                mtimes = group.get("mtime_ns", {})
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Skipping malformed plan line {line_no}: {e}")
+                continue
+            groups += 1
+            try:
+                keep_stat = os.stat(keep)
+            except OSError as e:
+                print(f"Keeper missing, skipping group: {keep} ({e})")
+                skipped += len(to_delete)
+                continue
+            if keep_stat.st_size != size or (keep in mtimes and keep_stat.st_mtime_ns != mtimes[keep]):
+                print(f"Keeper changed since the scan, skipping group: {keep}")
+                skipped += len(to_delete)
+                continue
+            for path in to_delete:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    print(f"Already gone: {path}")
+                    skipped += 1
+                    continue
+                if stat.st_size != size or (path in mtimes and stat.st_mtime_ns != mtimes[path]):
+                    print(f"Changed since the scan, skipping: {path}")
+                    skipped += 1
+                    continue
+                if (stat.st_dev, stat.st_ino) == (keep_stat.st_dev, keep_stat.st_ino):
+                    print(f"Already hardlinked to keeper, skipping: {path}")
+                    skipped += 1
+                    continue
+                if not delete:
+                    print(f"[DRY RUN] Would {'link' if link else 'delete'}: {path} (keeping {keep})")
+                    removed += 1
+                    reclaimed += size
+                    continue
+                remover.submit(path, keep, f"plan: {group.get('reason', '')}", size)
+
+    if remover:
+        remover.close()
+        removed += remover.removed
+        reclaimed += remover.removed_bytes
+        skipped += remover.skipped
+        failed += remover.failed
+
+    if delete:
+        verb = "Linked" if link else "Deleted"
+    else:
+        verb = "Would link" if link else "Would delete"
+    print("\n=== SUMMARY ===")
+    print(f"Mode: {'APPLY' if delete else 'DRY RUN'}")
+    print(f"Groups: {groups}")
+    print(f"{verb}: {removed} ({format_bytes(reclaimed)})")
+    print(f"Skipped: {skipped}")
+    print(f"Failed: {failed}")
+
+def resolve_cluster(members, rules=None, keep_order=None, link=None, remover=None):
+    """Keep one file of a group of identical Candidates and delete (or link) the rest.
+
+    Members that lose to another under a precedence rule are always removed.
+    Among the rest, the keeper is chosen automatically when they are all in
+    one directory (oldest wins, as before) or keep_order is given; otherwise
+    the user is asked once for the whole group. Removals are queued on the
+    remover; without one this is a dry run.
+    Returns how many files were queued for removal.
+    """
+    print(f"\nDuplicate group ({len(members)} files, {format_bytes(members[0].size)} each):")
+    for n, c in enumerate(members, 1):
+        print(f"  [{n}] {c.full_path}")
+    losers = precedence_losers(members, rules)
+    remaining = [c for c in members if c.full_path not in losers] or list(members)
+    order = keep_order or DEFAULT_KEEP_ORDER
+    keeper = rank_keeper(remaining, order)
+    reason = f"keep order {','.join(order)}"
+    survivors = [keeper]
+    if len(remaining) > 1 and not keep_order and len({c.dirpath for c in remaining}) > 1:
+        choices = ", ".join(str(members.index(c) + 1) for c in remaining)
+        if remover is None:
+            print(f"[DRY RUN] Would prompt for which of [{choices}] to keep.")
+            survivors = remaining
+        else:
+            remover.drain()
+            selection = input(f"Which to keep? [{choices}] (type anything else to keep all of them)> ")
+            picked = [c for c in remaining if selection.strip() == str(members.index(c) + 1)]
+            if picked:
+                keeper = picked[0]
+                survivors = [keeper]
+                reason = "user choice"
+            else:
+                print(f"Keeping all of [{choices}]")
+                survivors = remaining
+
+    if len(survivors) == 1:
+        print(f"Keeping: {keeper.full_path}")
+    queued = 0
+    for c in members:
+        if c in survivors:
+            continue
+        why = f"precedence rule {losers[c.full_path]}" if c.full_path in losers else reason
+        if remover is None:
+            print(f"[DRY RUN] Would {'link' if link else 'delete'}: {c.full_path} ({why})")
+            continue
+        remover.submit(c.full_path, keeper.full_path, why, c.size)
+        queued += 1
+    return queued
 
 def check_for_duplicates(
     paths,
@@ -125,131 +912,249 @@ def check_for_duplicates(
     record_name=".dedup_hashes.json",
     min_filesize=1024,  # Ignore files smaller than 1 KB by default
     no_read_hashes=False,
-    log_file=None
+    log_file=None,
+    partial_size=64 * 1024,
+    partial_samples=0,
+    jobs=1,
+    use_mmap=False,
+    index=None,
+    checkpoint_files=100,
+    checkpoint_seconds=30.0,
+    link=None,
+    plan_file=None,
+    keep_order=None,
+    excludes=(),
+    one_file_system=False,
+    walk_jobs=1,
+    incremental=False,
+    verify=False,
+    progress=None,
+    verbose=True
 ):
-    hashes = {}
-    dir_records = {}  # dirpath -> {filename: {mtime, size, hash}}
-    ignore_files = {".DS_Store", record_name}
+    progress = progress or Progress()
+    ignore_files = {".DS_Store", record_name, record_name + ".tmp"}
+    if index:
+        db_name = os.path.basename(index.db_path)
+        ignore_files |= {db_name, db_name + "-wal", db_name + "-shm"}
+
+    # Stage 1: walk and stat everything, counting candidates per size. A file
+    # whose size is unique can't have a duplicate, so it never needs hashing.
+    # Each directory's hash record is only needed while its files are added
+    # to the table, which keeps the digests that are still valid.
+    partial_spec = f"{partial_size}:{partial_samples}"
+    hashobj = hashfunc()
+    # Tag records with the algorithm's own name ("XXH64" -> "xxh64" matches --hash)
+    table = CandidateTable(hashobj.name.lower(), hashobj.digest_size, partial_spec)
+    size_counts = defaultdict(int)
+    # (st_dev, st_ino) -> table index, for files with more than one link.
+    # Extra links to an inode share its data, so they are reported, not hashed.
+    inodes = {}
+    hardlinks = 0
+    hardlinked_bytes = 0
+    progress.start_stage("walk")
     for path in paths:
-        for dirpath, dirnames, filenames in os.walk(path):
-            print(f"Checking directory: {dirpath}")
+        for dirpath, files in scan_tree(path, ignore_files, excludes, one_file_system, walk_jobs):
+            if verbose:
+                print(f"Checking directory: {dirpath}")
+            progress.add(dirs=1, files=len(files))
+            if min_filesize > 0:
+                # Ignore small files
+                files = [(filename, stat) for filename, stat in files if stat.st_size >= min_filesize]
+            if not files:
+                continue
             # Load hash record for this directory if present, unless bypassed
-            if not no_read_hashes:
-                dir_record = load_dir_hash_record(dirpath, record_name)
-            else:
+            if no_read_hashes:
                 dir_record = {}
-            dir_records[dirpath] = dir_record
+            elif index:
+                dir_record = index.load_dir(dirpath)
+            else:
+                dir_record = load_dir_hash_record(dirpath, record_name, verbose)
 
-            for filename in filenames:
-                if filename in ignore_files:
-                    continue
-                full_path = os.path.join(dirpath, filename)
-                try:
-                    stat = os.stat(full_path)
-                except Exception as e:
-                    print(f"Could not stat file {full_path}: {e}")
-                    continue
-                mtime = int(stat.st_mtime)
-                size = stat.st_size
-                if min_filesize > 0 and size < min_filesize:
-                    # Ignore small files
+            dir_id = table.dir_id(dirpath)
+            for filename, stat in files:
+                if stat.st_nlink > 1:
+                    inode = (stat.st_dev, stat.st_ino)
+                    if inode in inodes:
+                        if verbose:
+                            print(f"Already hardlinked:\n  {os.path.join(dirpath, filename)}\n  {table[inodes[inode]].full_path}")
+                        hardlinks += 1
+                        hardlinked_bytes += stat.st_size
+                        continue
+                    inodes[inode] = len(table)
+                table.append(dir_id, filename, stat, dir_record.get(filename))
+                size_counts[stat.st_size] += 1
+
+    # The files walked this run; in incremental mode, indexed files from
+    # earlier runs that share a size with one of them are appended after
+    new_count = len(table)
+    if incremental:
+        walked = {(os.path.abspath(table.dirs[table.dir_ids[idx]]), table.names[idx]) for idx in range(new_count)}
+        # Index rows are absolute; spell them like the walked paths, so
+        # precedence rules and plans see one form of path whatever the mode
+        relative = not any(os.path.isabs(path) for path in paths)
+        for size in list(size_counts):
+            for dirpath, filename, rec, stat in index.lookup_size(size):
+                if (dirpath, filename) in walked or stat.st_size != size:
                     continue
-                file_hash = get_file_hash(
-                    full_path, hashfunc, mtime, size, dir_record, filename,
-                    dirpath, record_name, record_hashes
-                )
-
-                # Use (hash, size) as key for deduplication
-                file_id = (file_hash, size)
-
-                duplicate = hashes.get(file_id, None)
-                if duplicate:
-                    print(f"\nDuplicate found:\n  [1] {full_path}\n  [2] {duplicate}")
-                    keep, to_delete, rule_used = None, None, None
-                    if precedence_rules:
-                        keep, to_delete, rule_used = match_precedence_rule(precedence_rules, full_path, duplicate)
-                    if keep and to_delete:
-                        print(f"Precedence rule: KEEP {keep}, DELETE {to_delete}")
-                        if delete:
-                            try:
-                                os.remove(to_delete)
-                                print(f"Deleted (by rule): {to_delete}")
-                                if log_file:
-                                    log_deletion(log_file, to_delete, keep, f"precedence rule {rule_used}")
-                            except Exception as e:
-                                print(f"Could not delete {to_delete}: {e}")
-                        else:
-                            print(f"[DRY RUN] Would delete (by rule): {to_delete}")
-                        hashes[file_id] = keep
+                if relative:
+                    dirpath = os.path.relpath(dirpath)
+                if stat.st_nlink > 1:
+                    inode = (stat.st_dev, stat.st_ino)
+                    if inode in inodes:
+                        if verbose:
+                            print(f"Already hardlinked:\n  {os.path.join(dirpath, filename)}\n  {table[inodes[inode]].full_path}")
+                        hardlinks += 1
+                        hardlinked_bytes += size
                         continue
-                    if delete:
-                        path1 = full_path
-                        path2 = duplicate
-
-                        if os.path.dirname(path1) == os.path.dirname(path2):
-                            time1 = os.path.getmtime(path1)
-                            time2 = os.path.getmtime(path2)
-
-                            print("Files are in the same directory: deleting newest")
-
-                            if time1 > time2:
-                                print(f"Deleting:\n  [1] {path1}")
-
-                                try:
-                                    os.remove(path1)
-                                    if log_file:
-                                        log_deletion(log_file, path1, path2, "deleted newest in the same directory")
-                                except:
-                                    print(f"Could not find file:\n  {path1}\nContinuing...")
-                                hashes[file_id] = path2
-
-                            else:
-                                print(f"Deleting:\n  [2] {path2}")
-                                try:
-                                    os.remove(path2)
-                                    if log_file:
-                                        log_deletion(log_file, path2, path1, "deleted newest in the same directory")
-                                except:
-                                    print(f"Could not find file:\n  {path2}\nContinuing...")
-                                hashes[file_id] = path1
-
-                        else:
-                            selection = input("Which to delete? [1/2] (type anything else to keep both)> ")
-
-                            if selection == "1":
-                                print(f"Deleting:\n  [1] {path1}")
-
-                                try:
-                                    os.remove(path1)
-                                    if log_file:
-                                        log_deletion(log_file, path1, path2, "user choice")
-                                except:
-                                    print(f"Could not find file:\n  {path1}\nContinuing...")
-
-                                hashes[file_id] = path2
-
-                            elif selection == "2":
-                                print(f"Deleting:\n  [2] {path2}")
-
-                                try:
-                                    os.remove(path2)
-                                    if log_file:
-                                        log_deletion(log_file, path2, path1, "user choice")
-                                except:
-                                    print(f"Could not find file:\n  {path2}\nContinuing...")
-
-                            else:
-                                print("Not deleting either image")
-                    else:
-                        print("[DRY RUN] Would prompt for deletion or keep both.")
-                else:
-                    hashes[file_id] = full_path
+                    inodes[inode] = len(table)
+                table.append(table.dir_id(dirpath), filename, stat, rec)
+                size_counts[size] += 1
+        del walked
+        print(f"\nIncremental: {new_count} new files, {len(table) - new_count} indexed files share a size with them")
+
+    if index:
+        # Index every candidate, hashed or not, so later --incremental runs
+        # know which sizes already exist
+        for idx in range(len(table)):
+            if table.status[idx] & REC_MASK != REC_OK:
+                c = table[idx]
+                index.put(c.dirpath, c.filename, c.dev, c.ino, table.record(idx))
+
+    if hardlinks:
+        print(f"\nFound {hardlinks} existing hardlinks sharing {format_bytes(hardlinked_bytes)}, each inode is hashed once")
+
+    skipped_files = 0
+    skipped_bytes = 0
+    for idx, size in enumerate(table.sizes):
+        if size_counts[size] == 1:
+            skipped_files += 1
+            # Only count bytes we would actually have read, not cache hits
+            if table.reason(idx):
+                skipped_bytes += size
+    progress.results.update(
+        candidates=len(table), hardlinks=hardlinks, unique_size_files=skipped_files, unique_size_bytes=skipped_bytes
+    )
+    print(f"\n{len(table)} candidate files, {len(table) - skipped_files} share a size with another file")
+    print(f"Skipped hashing {skipped_files} files with a unique size, avoided reading {format_bytes(skipped_bytes)}")
+
+    checkpoint = None
+    remover = None
+    if record_hashes and not index:
+        checkpoint = RecordCheckpointer(record_name, checkpoint_files, checkpoint_seconds, verbose)
+    try:
+        # Stage 2: split each size group with a cheap partial hash of the head and
+        # tail (and optional middle) blocks. Files too small to sample go straight
+        # to the full hash since the partial hash would read all of them anyway.
+        # Colliding files are ordered by size (stable, so walk order within a
+        # size) and every later stage works on one run of equal sizes at a time.
+        colliding = array("q", sorted(
+            (idx for idx, size in enumerate(table.sizes) if size_counts[size] > 1),
+            key=table.sizes.__getitem__
+        ))
+        size_counts.clear()
+        min_sampled = partial_size * (partial_samples + 2) if partial_size > 0 else None
+        # Hash in walk order, like everything else that touches the disk
+        sampled = array("q", sorted(idx for idx in colliding if min_sampled is not None and table.sizes[idx] > min_sampled))
+        hash_candidates(
+            table, sampled, "partial_hash",
+            lambda full_path, size: compute_partial_hash(full_path, hashfunc, size, partial_size, partial_samples),
+            jobs, checkpoint, index, progress, lambda size: min_sampled, verbose
+        )
+        del sampled
+
+        to_hash = array("q")
+        ruled_out_files = 0
+        ruled_out_bytes = 0
+        for size, run in itertools.groupby(colliding, key=table.sizes.__getitem__):
+            if min_sampled is None or size <= min_sampled:
+                to_hash.extend(run)
+                continue
+            by_partial = defaultdict(list)
+            for idx in run:
+                digest = table.digest(idx, "partial_hash")
+                if digest is not None:  # else unreadable
+                    by_partial[digest].append(idx)
+            for members in by_partial.values():
+                if len(members) > 1:
+                    to_hash.extend(members)
+                    continue
+                ruled_out_files += 1
+                if table.reason(members[0]):
+                    ruled_out_bytes += size
+        del colliding
+        progress.results.update(partial_ruled_out_files=ruled_out_files, partial_ruled_out_bytes=ruled_out_bytes)
+        if min_sampled is not None:
+            print(f"Partial hashes ruled out {ruled_out_files} more files, avoided reading {format_bytes(ruled_out_bytes)}")
+
+        # Stage 3: full hash only files still colliding
+        to_hash = array("q", sorted(to_hash))
+        hash_candidates(
+            table, to_hash, "hash",
+            lambda full_path, size: compute_file_hash(full_path, hashfunc, use_mmap),
+            jobs, checkpoint, index, progress, None, verbose
+        )
+
+        # Stage 4: build full duplicate clusters of candidate indices. Members
+        # are in walk order, but which one is kept never depends on it.
+        progress.start_stage("resolve")
+        # Clusters are found one size at a time, so only the current size's
+        # digests are ever held in a dict.
+        clusters = []  # [candidate index], ordered by first member
+        for size, run in itertools.groupby(sorted(to_hash, key=table.sizes.__getitem__), key=table.sizes.__getitem__):
+            by_hash = defaultdict(list)
+            for idx in run:
+                digest = table.digest(idx, "hash")
+                if digest is not None:
+                    by_hash[digest].append(idx)
+            # In incremental mode only clusters with a new file are of interest
+            clusters.extend(members for members in by_hash.values() if len(members) > 1 and members[0] < new_count)
+        del to_hash
+        clusters.sort()
+        groups = [
+            ((table.digest(members[0], "hash"), table.sizes[members[0]]), [table[idx] for idx in members])
+            for members in clusters
+        ]
+        del clusters
+        progress.results.update(
+            duplicate_groups=len(groups),
+            duplicate_files=sum(len(members) - 1 for file_id, members in groups),
+            reclaimable_bytes=sum(size * (len(members) - 1) for (file_hash, size), members in groups)
+        )
+
+        if plan_file:
+            # Leave every decision to apply_plan
+            write_plan(plan_file, groups, precedence_rules, keep_order or DEFAULT_KEEP_ORDER, table.algorithm)
+            progress.completed = True
+            return
+
+        # Stage 5: one keep/delete decision per cluster. Removals drain on a
+        # background thread while the next groups are decided.
+        if delete:
+            remover = Remover(log_file, link, verify)
+        for (file_hash, size), members in groups:
+            queued = resolve_cluster(members, precedence_rules, keep_order, link, remover)
+            progress.add(groups=1, queued_files=queued)
+        if remover:
+            remover.close()
+            progress.add(
+                removed_files=remover.removed, removed_bytes=remover.removed_bytes,
+                skipped_files=remover.skipped, failed_files=remover.failed
+            )
+            remover = None
+        progress.completed = True
+    finally:
+        # Finish removals already decided, and save whatever was hashed since
+        # the last checkpoint, including on Ctrl-C
+        if remover:
+            remover.close()
+        if checkpoint:
+            checkpoint.flush()
 
 def main():
     parser = argparse.ArgumentParser(
         description="Find and optionally delete duplicate files in given directories."
     )
-    parser.add_argument("paths", nargs="+", help="Directories to check for duplicates")
+    parser.add_argument("paths", nargs="*", help="Directories to check for duplicates")
     parser.add_argument("-d", "--delete", action="store_true", help="Delete duplicates interactively or by rule")
     parser.add_argument("--precedence-rules", help="Path to precedence_rules.json for auto-deletion rules")
     parser.add_argument("--record-hashes", action="store_true", help="Store and update per-directory JSON hash records for resumability")
@@ -258,10 +1163,37 @@ def main():
     parser.add_argument("--no-read-hashes", action="store_true", help="Do not read from per-directory hash record files even if present")
     parser.add_argument("--log-file", default="dedup_deletions.log", help="Append all deletions to this log file as JSON lines (default: dedup_deletions.log)")
     parser.add_argument("--no-log-file", action="store_true", help="Do not log deletions to a file")
+    parser.add_argument("--checkpoint-files", type=int, default=100, help="With --record-hashes, save records after this many new hashes (default: 100)")
+    parser.add_argument("--checkpoint-seconds", type=float, default=30.0, help="With --record-hashes, save records at least this often in seconds (default: 30)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="Skip files and directories whose name or path matches this glob (repeatable)")
+    parser.add_argument("--one-file-system", action="store_true", help="Don't descend into directories on other filesystems")
+    parser.add_argument("--walk-jobs", type=int, default=1, help="List directories in parallel with this many threads, useful on high-latency filesystems (default: 1)")
+    parser.add_argument("--link", nargs="?", const="hardlink", choices=["hardlink", "reflink"], help="With --delete, replace duplicates with a hardlink (default) or reflink to the kept copy instead of deleting them")
+    parser.add_argument("--keep-order", type=parse_keep_order, help=f"Pick the copy to keep automatically by these comma-separated criteria instead of prompting ({', '.join(KEEP_CRITERIA)}); --plan defaults to {','.join(DEFAULT_KEEP_ORDER)}")
+    parser.add_argument("--plan", metavar="PLAN_FILE", help="Scan without deleting or prompting and write every duplicate group with a suggested keeper to this JSONL file")
+    parser.add_argument("--apply-plan", metavar="PLAN_FILE", help="Carry out a plan written by --plan instead of scanning (a dry run unless --delete is given)")
+    parser.add_argument("--partial-size", type=int, default=64, help="KiB read from the start and end of each file for the partial hash prefilter (default: 64, set to 0 to disable)")
+    parser.add_argument("--partial-samples", type=int, default=0, help="Number of extra evenly spaced middle blocks to include in the partial hash (default: 0)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files to hash in parallel (default: 1)")
+    parser.add_argument("--mmap", action="store_true", help="Hash large files through mmap instead of buffered reads")
+    parser.add_argument("--hash", default=DEFAULT_HASH, choices=sorted(HASH_ALGORITHMS), help=f"Hash algorithm; xxh64, xxh3_128 and blake3 are offered when installed (default: {DEFAULT_HASH})")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Don't print a line per directory and file; report progress on stderr every --progress-seconds instead")
+    parser.add_argument("--progress-seconds", type=float, default=5.0, help="With --quiet, seconds between progress lines (default: 5)")
+    parser.add_argument("--stats-json", metavar="FILE", help="Write counters and timings for each stage of the run to this JSON file")
+    parser.add_argument("--verify", action="store_true", help="Compare each duplicate byte for byte with the kept copy before deleting or linking it")
+    parser.add_argument("--index-db", help="Read and write hashes in this central SQLite index instead of per-directory JSON records")
+    parser.add_argument("--incremental", action="store_true", help="Only walk the given paths and check their files against everything already in --index-db")
+    parser.add_argument("--import-records", action="store_true", help="Import existing per-directory JSON hash records under the given paths into --index-db first")
     args = parser.parse_args()
 
-    if not args.record_hashes:
-        print("Warning: --record-hashes not set, hashes will not be persisted for the next run.", file=sys.stderr)
+    if not args.paths and not args.apply_plan:
+        parser.error("at least one path is required")
+    if args.plan and args.apply_plan:
+        parser.error("--plan and --apply-plan can't be used together")
+    if args.import_records and not args.index_db:
+        parser.error("--import-records requires --index-db")
+    if args.incremental and not args.index_db:
+        parser.error("--incremental requires --index-db")
 
     log_file = None
     if args.no_log_file:
@@ -269,18 +1201,60 @@ def main():
     else:
         log_file = args.log_file
 
+    if args.apply_plan:
+        apply_plan(args.apply_plan, args.delete, args.link, log_file, args.verify)
+        return
+
+    index = None
+    if args.index_db:
+        index = HashIndex(args.index_db)
+        if args.import_records:
+            imported, stale = index.import_json_records(args.paths, args.record_name)
+            print(f"Imported {imported} hash records into {args.index_db} ({stale} stale entries skipped)")
+    elif not args.record_hashes:
+        print("Warning: --record-hashes not set, hashes will not be persisted for the next run.", file=sys.stderr)
+
     precedence_rules = load_precedence_rules(args.precedence_rules) if args.precedence_rules else None
 
-    check_for_duplicates(
-        args.paths,
-        delete=args.delete,
-        precedence_rules=precedence_rules,
-        record_hashes=args.record_hashes,
-        record_name=args.record_name,
-        min_filesize=args.min_filesize,
-        no_read_hashes=args.no_read_hashes,
-        log_file=log_file
-    )
+    # Turn SIGTERM into a normal exit so pending hash records still get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    progress = Progress(args.progress_seconds, show=args.quiet)
+    try:
+        check_for_duplicates(
+            args.paths,
+            delete=args.delete,
+            precedence_rules=precedence_rules,
+            record_hashes=args.record_hashes,
+            record_name=args.record_name,
+            min_filesize=args.min_filesize,
+            no_read_hashes=args.no_read_hashes,
+            log_file=log_file,
+            partial_size=args.partial_size * 1024,
+            partial_samples=args.partial_samples,
+            jobs=args.jobs,
+            use_mmap=args.mmap,
+            index=index,
+            checkpoint_files=args.checkpoint_files,
+            checkpoint_seconds=args.checkpoint_seconds,
+            link=args.link,
+            plan_file=args.plan,
+            keep_order=args.keep_order,
+            excludes=args.exclude,
+            one_file_system=args.one_file_system,
+            walk_jobs=args.walk_jobs,
+            incremental=args.incremental,
+            hashfunc=HASH_ALGORITHMS[args.hash],
+            verify=args.verify,
+            progress=progress,
+            verbose=not args.quiet
+        )
+    finally:
+        if index:
+            index.close()
+        if args.stats_json:
+            # Also written after Ctrl-C or an error, with "completed": false
+            progress.write_json(args.stats_json)
 
 if __name__ == "__main__":
     main()
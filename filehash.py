@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""Shared whole-file hashing for dedup.py and mirror-move/generate_hash_map.py.
+
+Files are read with readinto() into one reused buffer, so hashing a multi-GB
+file takes a few thousand Python-level calls and allocates nothing per
+chunk. Large files can optionally be hashed straight from an mmap. Sequential
+access is hinted to the kernel where posix_fadvise/madvise are available.
+
+HASH_ALGORITHMS maps the names accepted by dedup.py --hash to hash
+constructors. xxhash and blake3 are offered when those packages are
+installed.
+
+Run this module directly to benchmark the read strategies, or with
+--algorithms to compare the hash algorithms, on your own files:
+
+    python filehash.py /path/to/big/file [more files...]
+    python filehash.py --algorithms /path/to/big/file
+"""
+import os
+import sys
+import mmap
+import time
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024  # 1 MiB
+MMAP_MIN_SIZE = 64 * 1024 * 1024  # mmap only pays off on large files
+
+DEFAULT_HASH = "sha256"
+HASH_ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "sha512": hashlib.sha512,
+    "blake2b": hashlib.blake2b,
+    "blake2s": hashlib.blake2s,
+}
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh64"] = xxhash.xxh64
+    HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+if blake3 is not None:
+    HASH_ALGORITHMS["blake3"] = blake3.blake3
+
+
+def advise_sequential(fd):
+    """Tell the kernel we'll read this file front to back (no-op where unsupported)."""
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def update_from_file(hashobj, f, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Feed an open binary file into hashobj using one reused buffer."""
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        hashobj.update(view[:n])
+    return hashobj
+
+
+def update_from_mmap(hashobj, f):
+    """Feed an open binary file into hashobj through a read-only mmap."""
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        hashobj.update(mm)
+    return hashobj
+
+
+def hash_file(path, hashfunc=hashlib.sha256, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False):
+    """Hash a whole file and return the hash object.
+
+    With use_mmap, files of at least MMAP_MIN_SIZE bytes are hashed from an
+    mmap instead of buffered reads. Empty files can't be mapped and always
+    take the buffered path.
+    """
+    hashobj = hashfunc()
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        advise_sequential(fd)
+        if use_mmap and os.fstat(fd).st_size >= MMAP_MIN_SIZE:
+            return update_from_mmap(hashobj, f)
+        return update_from_file(hashobj, f, buffer_size)
+
+
+def files_identical(path1, path2, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Compare two files byte for byte."""
+    with open(path1, "rb") as f1, open(path2, "rb") as f2:
+        if os.fstat(f1.fileno()).st_size != os.fstat(f2.fileno()).st_size:
+            return False
+        advise_sequential(f1.fileno())
+        advise_sequential(f2.fileno())
+        buf1 = bytearray(buffer_size)
+        buf2 = bytearray(buffer_size)
+        while True:
+            n = f1.readinto(buf1)
+            if f2.readinto(buf2) != n:
+                return False
+            if not n:
+                return True
+            # Whole bytearrays compare with memcmp; memoryviews compare item by item
+            if (buf1 != buf2) if n == buffer_size else (buf1[:n] != buf2[:n]):
+                return False
+
+
+def ordered_pool_map(func, items, jobs=1):
+    """Like map(func, items), but runs func in a thread pool when jobs > 1.
+
+    Results are yielded in input order. At most a few items per worker are in
+    flight at once, so huge file lists don't turn into millions of futures.
+    hashlib releases the GIL while hashing, so threads scale on I/O and CPU.
+    """
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(executor.submit(func, item))
+            if len(in_flight) >= jobs * 4:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def format_duration(seconds):
+    """Format seconds as H:MM:SS for progress lines."""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def _hash_with_read(path, hashfunc, chunk_size):
+    # The old per-chunk read() loop, kept for comparison in the benchmark
+    hashobj = hashfunc()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hashobj.update(chunk)
+    return hashobj
+
+
+def _hash_with_mmap(path, hashfunc):
+    # mmap regardless of MMAP_MIN_SIZE so small benchmark files still use it
+    hashobj = hashfunc()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            update_from_mmap(hashobj, f)
+    return hashobj
+
+
+def benchmark(paths, hashfunc=hashlib.sha256, repeat=3):
+    """Print MB/s for each read strategy over the given files (best of `repeat`)."""
+    strategies = [
+        ("read() 1 KiB", lambda p: _hash_with_read(p, hashfunc, 1024)),
+        ("read() 8 KiB", lambda p: _hash_with_read(p, hashfunc, 8192)),
+        ("readinto() 64 KiB", lambda p: hash_file(p, hashfunc, 64 * 1024)),
+        ("readinto() 1 MiB", lambda p: hash_file(p, hashfunc, DEFAULT_BUFFER_SIZE)),
+        ("mmap", lambda p: _hash_with_mmap(p, hashfunc)),
+    ]
+    total_bytes = sum(os.path.getsize(p) for p in paths)
+    if not total_bytes:
+        print("Nothing to benchmark: files are empty", file=sys.stderr)
+        return
+    print(f"Hashing {len(paths)} file(s), {total_bytes / 1e6:.1f} MB, best of {repeat}")
+    # Warm the page cache so every strategy sees the same conditions
+    for path in paths:
+        hash_file(path, hashfunc)
+    expected = None
+    for name, func in strategies:
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            digests = [func(p).hexdigest() for p in paths]
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        if expected is None:
+            expected = digests
+        elif digests != expected:
+            print(f"  {name}: digest mismatch!", file=sys.stderr)
+        print(f"  {name:<20} {total_bytes / 1e6 / best:10.1f} MB/s")
+
+
+def benchmark_algorithms(paths, names=None, repeat=3):
+    """Print MB/s for each hash algorithm over the given files (best of `repeat`)."""
+    names = names or list(HASH_ALGORITHMS)
+    total_bytes = sum(os.path.getsize(p) for p in paths)
+    if not total_bytes:
+        print("Nothing to benchmark: files are empty", file=sys.stderr)
+        return
+    print(f"Hashing {len(paths)} file(s), {total_bytes / 1e6:.1f} MB, best of {repeat}")
+    for path in paths:
+        hash_file(path)
+    for name in names:
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for path in paths:
+                hash_file(path, HASH_ALGORITHMS[name])
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"  {name:<20} {total_bytes / 1e6 / best:10.1f} MB/s")
+    missing = [pkg for pkg, mod in (("xxhash", xxhash), ("blake3", blake3)) if mod is None]
+    if missing:
+        print(f"Not installed: {', '.join(missing)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark file hashing read strategies or hash algorithms (MB/s)."
+    )
+    parser.add_argument("files", nargs="+", help="Files to hash")
+    parser.add_argument("--hash", default=DEFAULT_HASH, choices=sorted(HASH_ALGORITHMS), help=f"Algorithm for the read strategy benchmark (default: {DEFAULT_HASH})")
+    parser.add_argument("--algorithms", action="store_true", help="Compare every available hash algorithm instead of read strategies")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per strategy, best is reported (default: 3)")
+    args = parser.parse_args()
+
+    if args.algorithms:
+        benchmark_algorithms(args.files, repeat=args.repeat)
+    else:
+        benchmark(args.files, HASH_ALGORITHMS[args.hash], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
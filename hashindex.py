@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Central SQLite hash index for dedup.py.
+
+An alternative to writing a .dedup_hashes.json file into every directory.
+One database in WAL mode holds a row per file, keyed by its absolute path
+and indexed by (st_dev, st_ino). Each row has size, mtime_ns and digests.
+Writes are queued and committed in batches, so recording a new hash costs
+one INSERT rather than rewriting a whole directory's JSON.
+
+Rows are handed to dedup.py as the same {filename: {mtime, size, hash, ...}}
+dicts that load_dir_hash_record returns, so both stores work the same way.
+Each row is tagged with the algorithm that produced its digests; rows
+without a tag come from before tagging and hold SHA-256 digests.
+
+Every candidate file seen by a run is indexed, hashed or not, and rows are
+also indexed by (size, hash). That lets dedup.py --incremental check a few
+new files against everything seen before without walking it again. Rows
+for files that have since disappeared are dropped when a lookup finds them.
+"""
+import os
+import json
+import sqlite3
+from stat import S_ISREG
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    dev INTEGER,
+    ino INTEGER,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash BLOB,
+    partial_hash BLOB,
+    partial_spec TEXT,
+    algorithm TEXT,
+    PRIMARY KEY (dir, name)
+);
+CREATE INDEX IF NOT EXISTS files_inode ON files (dev, ino);
+CREATE INDEX IF NOT EXISTS files_content ON files (size, hash);
+"""
+
+
+class HashIndex:
+    def __init__(self, db_path, batch_size=1000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_deletes = []
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL only risks the last few transactions on power loss, never corruption
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        if "algorithm" not in columns:
+            # Indexes from before digests were tagged; their rows are all SHA-256
+            with self.conn:
+                self.conn.execute("ALTER TABLE files ADD COLUMN algorithm TEXT")
+
+    @staticmethod
+    def _record(size, mtime_ns, file_hash, partial_hash, partial_spec, algorithm):
+        rec = {"mtime": mtime_ns // 1_000_000_000, "mtime_ns": mtime_ns, "size": size}
+        if algorithm is not None:
+            rec["algorithm"] = algorithm
+        if file_hash is not None:
+            rec["hash"] = bytes(file_hash)
+        if partial_hash is not None:
+            rec["partial_hash"] = bytes(partial_hash)
+            rec["partial_spec"] = partial_spec
+        return rec
+
+    def load_dir(self, dirpath):
+        """Return {filename: record} for every indexed file in dirpath"""
+        rows = self.conn.execute(
+            "SELECT name, size, mtime_ns, hash, partial_hash, partial_spec, algorithm FROM files WHERE dir = ?",
+            (os.path.abspath(dirpath),)
+        )
+        return {row[0]: self._record(*row[1:]) for row in rows}
+
+    def lookup_size(self, size):
+        """Yield (dirpath, filename, record, stat_result) for indexed files of this size.
+
+        Each file is stat-ed, and rows for files that no longer exist (or
+        are no longer regular files) are expired on the spot. A file that
+        changed is still returned, with its current stat, so the caller can
+        see that its record is stale.
+        """
+        self.flush()
+        rows = self.conn.execute(
+            "SELECT dir, name, mtime_ns, hash, partial_hash, partial_spec, algorithm FROM files WHERE size = ?",
+            (size,)
+        ).fetchall()
+        for dirpath, name, mtime_ns, file_hash, partial_hash, partial_spec, algorithm in rows:
+            try:
+                stat = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                self.forget(dirpath, name)
+                continue
+            except OSError:
+                continue
+            if not S_ISREG(stat.st_mode):
+                # Replaced by a symlink or directory; dedup only indexes regular files
+                self.forget(dirpath, name)
+                continue
+            yield dirpath, name, self._record(size, mtime_ns, file_hash, partial_hash, partial_spec, algorithm), stat
+
+    def forget(self, dirpath, filename):
+        """Queue removal of a file's row"""
+        self.pending_deletes.append((os.path.abspath(dirpath), filename))
+        if len(self.pending_deletes) >= self.batch_size:
+            self.flush()
+
+    def put(self, dirpath, filename, dev, ino, rec):
+        """Queue a record entry for writing; commits once batch_size entries are queued"""
+        self.pending.append((
+            os.path.abspath(dirpath), filename, dev, ino, rec["size"], rec["mtime_ns"],
+            rec.get("hash"), rec.get("partial_hash"), rec.get("partial_spec"), rec.get("algorithm")
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending and not self.pending_deletes:
+            return
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE dir = ? AND name = ?", self.pending_deletes)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files"
+                " (dir, name, dev, ino, size, mtime_ns, hash, partial_hash, partial_spec, algorithm)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.pending
+            )
+        self.pending = []
+        self.pending_deletes = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def import_json_records(self, paths, record_name):
+        """Import per-directory JSON hash records found under paths.
+
+        Each entry is checked against the file on disk, and only entries whose
+        size and mtime_ns still match are imported (whole-second mtime for
+        older entries without mtime_ns), with the file's st_dev and st_ino.
+        Entries with unreadable digests count as stale. Returns (imported,
+        stale) counts.
+        """
+        imported = 0
+        stale = 0
+        for path in paths:
+            for dirpath, dirnames, filenames in os.walk(path):
+                if record_name not in filenames:
+                    continue
+                record_path = os.path.join(dirpath, record_name)
+                try:
+                    with open(record_path, "r") as f:
+                        record = json.load(f)
+                except Exception as e:
+                    print(f"Could not load hash record {record_path}: {e}")
+                    continue
+                for fname, meta in record.items():
+                    try:
+                        stat = os.stat(os.path.join(dirpath, fname))
+                    except OSError:
+                        stale += 1
+                        continue
+                    if (meta.get("size") != stat.st_size or meta.get("mtime") != int(stat.st_mtime)
+                            or meta.get("mtime_ns", stat.st_mtime_ns) != stat.st_mtime_ns):
+                        stale += 1
+                        continue
+                    rec = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                    try:
+                        for field in ("hash", "partial_hash"):
+                            if isinstance(meta.get(field), str):
+                                rec[field] = bytes.fromhex(meta[field])
+                    except ValueError:
+                        print(f"Skipping {fname} in {record_path}: bad digest")
+                        stale += 1
+                        continue
+                    if "partial_hash" in rec:
+                        rec["partial_spec"] = meta.get("partial_spec")
+                    if "algorithm" in meta:
+                        rec["algorithm"] = meta["algorithm"]
+                    self.put(dirpath, fname, stat.st_dev, stat.st_ino, rec)
+                    imported += 1
+                print(f"Imported hash record from {record_path}")
+        self.flush()
+        return imported, stale
@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 import os
 import sys
+import errno
 import json
 import shutil
+import sqlite3
+import threading
 import argparse
 import logging
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import hashmap
+
+DEFAULT_JOBS = 8
+OUTPUT_BATCH_SIZE = 1000
+JOURNAL_SYNC_EVERY = 1000
+
 def setup_logging(log_file=None, verbose=False):
     """Setup logging configuration."""
     log_level = logging.INFO if verbose else logging.WARNING
@@ -32,35 +42,372 @@ def setup_logging(log_file=None, verbose=False):
 
     return logging.getLogger(__name__)
 
-def load_hash_map(json_file):
-    """Load hash map from JSON file."""
+def load_hash_map(map_file):
+    """Load a hash map in any format generate_hash_map.py has written (see hashmap.py)."""
     try:
-        with open(json_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (IOError, json.JSONDecodeError) as e:
-        print(f"Error loading {json_file}: {e}", file=sys.stderr)
+        return hashmap.load_hash_map(map_file)
+    except (IOError, ValueError, sqlite3.Error) as e:
+        print(f"Error loading {map_file}: {e}", file=sys.stderr)
         return {}
 
-def invert_hash_map(hash_map):
-    """Invert hash map to path -> hash for easier lookup."""
-    return {path: hash_val for hash_val, path in hash_map.items()}
+def match_paths(current_paths, target_paths):
+    """Pair up the current and target paths of one hash.
+
+    Paths in both lists are already in place. The rest are paired in
+    sorted order as moves. Returns (moves, missing, extra), where missing
+    are target paths with no spare current copy to move there and extra
+    are current copies that aren't needed anywhere.
+    """
+    in_place = set(current_paths) & set(target_paths)
+    sources = sorted(p for p in current_paths if p not in in_place)
+    targets = sorted(p for p in target_paths if p not in in_place)
+    moves = list(zip(sources, targets))
+    return moves, targets[len(moves):], sources[len(moves):]
+
+TEMP_SUFFIX = '.mirror-move-tmp'
+
+def pool_map(func, items, jobs=1):
+    """map(func, items), run in a pool of `jobs` threads when jobs > 1. Results come in input order."""
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(func, items)
+
+def plan_moves(moves, exists):
+    """Order (current_rel, target_rel, hash) moves so no move finds its target still occupied.
+
+    A move whose target is the source of another move has to wait for that
+    one, so chains (A->B, B->C) run from their free end back. What is left
+    after that are cycles (A->B, B->A, or longer rotations). Each is broken
+    by first parking one member under a temp name next to it and moving it
+    to its target last. exists(rel) tells whether a path is taken on disk.
+
+    Returns (groups, temp_paths). Each group is a list of steps, in the same
+    form as moves, that must run in order; separate groups touch separate
+    paths and can run at the same time. temp_paths is the set of temp paths
+    used.
+    """
+    by_source = {move[0]: move for move in moves}
+    by_target = {move[1]: move for move in moves}
+    groups = []
+    temp_paths = set()
+    done = set()
+
+    def run_chain(move, steps):
+        # Each move frees its source, which may be what another move waits for
+        while move is not None and move[0] not in done:
+            steps.append(move)
+            done.add(move[0])
+            move = by_target.get(move[0])
+        return steps
+
+    for move in moves:
+        if move[1] not in by_source:
+            groups.append(run_chain(move, []))
+    for move in sorted(moves):
+        if move[0] in done:
+            continue
+        current_rel, target_rel, file_hash = move
+        temp_rel = current_rel + TEMP_SUFFIX
+        n = 1
+        while temp_rel in by_source or temp_rel in by_target or exists(temp_rel):
+            temp_rel = f"{current_rel}{TEMP_SUFFIX}{n}"
+            n += 1
+        temp_paths.add(temp_rel)
+        done.add(current_rel)
+        steps = run_chain(by_target.get(current_rel), [(current_rel, temp_rel, file_hash)])
+        steps.append((temp_rel, target_rel, file_hash))
+        groups.append(steps)
+    return groups, temp_paths
+
+class TreeState:
+    """Listings of every directory a move plan touches, read once up front and updated as files move."""
+    def __init__(self, base_path, rel_paths, jobs=1):
+        self.base = str(base_path)
+        self.listings = {}
+        self.devices = {}
+        self.missing_dirs = []
+        dirs = sorted({os.path.dirname(rel) for rel in rel_paths})
+        for rel_dir, names, dev in pool_map(self._scan, dirs, jobs):
+            if names is None:
+                self.missing_dirs.append(rel_dir)
+                names = set()
+            self.listings[rel_dir] = names
+            self.devices[rel_dir] = dev
+        # Parent directories outside the plan: their device, or None if missing
+        self.parent_devices = {'': os.stat(self.base).st_dev}
+        for rel_dir in self.missing_dirs:
+            self.devices[rel_dir] = self._parent_device(rel_dir)
+
+    def _scan(self, rel_dir):
+        full = os.path.join(self.base, rel_dir)
+        try:
+            return rel_dir, set(os.listdir(full)), os.stat(full).st_dev
+        except (FileNotFoundError, NotADirectoryError):
+            return rel_dir, None, None
+
+    def _parent_device(self, rel_dir):
+        # Moves will create rel_dir; it lands on the filesystem of its closest existing parent
+        parent = os.path.dirname(rel_dir)
+        dev = self.devices.get(parent)
+        if dev is None and parent not in self.listings:
+            if parent not in self.parent_devices:
+                try:
+                    self.parent_devices[parent] = os.stat(os.path.join(self.base, parent)).st_dev
+                except OSError:
+                    self.parent_devices[parent] = None
+            dev = self.parent_devices[parent]
+        return dev if dev is not None else self._parent_device(parent)
+
+    def missing_parents(self):
+        """Parents of missing directories that are missing too, and not in the plan themselves."""
+        return [rel_dir for rel_dir, dev in self.parent_devices.items() if dev is None]
+
+    def exists(self, rel):
+        rel_dir, name = os.path.split(rel)
+        return name in self.listings[rel_dir]
+
+    def same_device(self, source_rel, target_rel):
+        return self.devices[os.path.dirname(source_rel)] == self.devices[os.path.dirname(target_rel)]
+
+    def removed(self, rel):
+        rel_dir, name = os.path.split(rel)
+        self.listings[rel_dir].discard(name)
+
+    def moved(self, source_rel, target_rel):
+        # set.add/discard are atomic, so worker threads can call this directly
+        rel_dir, name = os.path.split(source_rel)
+        self.listings[rel_dir].discard(name)
+        rel_dir, name = os.path.split(target_rel)
+        self.listings[rel_dir].add(name)
+
+def move_file(source, target, rename=True):
+    """Move source to target: in place, or with rename=False a copy across filesystems.
+
+    An existing target is never replaced; FileExistsError is raised instead,
+    even where the tree listing missed it (e.g. a name differing only in
+    case on macOS). In place, the file is hardlinked to target and then
+    unlinked, as os.rename would silently overwrite.
+    """
+    if rename and os.name == 'nt':
+        # rename already refuses to replace a file on Windows
+        os.rename(source, target)
+        return
+    if rename:
+        try:
+            os.link(source, target, follow_symlinks=False)
+        except FileExistsError:
+            raise
+        except OSError:
+            # No hardlinks on this filesystem (e.g. FAT or some network shares)
+            if os.path.lexists(target):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), target)
+            os.rename(source, target)
+            return
+        os.unlink(source)
+    else:
+        if os.path.lexists(target):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), target)
+        shutil.move(source, target)
 
-def ensure_directory(filepath, dry_run=True, logger=None):
-    """Ensure parent directory exists."""
-    parent = Path(filepath).parent
-    if not parent.exists():
-        if dry_run:
-            if logger:
-                logger.info(f"[DRY RUN] Would create directory: {parent}")
-            print(f"[DRY RUN] Would create directory: {parent}")
-        else:
-            parent.mkdir(parents=True, exist_ok=True)
-            if logger:
-                logger.info(f"Created directory: {parent}")
-            print(f"Created directory: {parent}")
+def linked_both(base, current_rel, target_rel):
+    """True if current_rel and target_rel are one file: a move that stopped between its link and unlink."""
+    try:
+        return os.path.samefile(os.path.join(base, current_rel), os.path.join(base, target_rel))
+    except OSError:
+        return False
+
+class BatchedOutput:
+    """Prints and logs messages a batch at a time; warnings and errors go to stderr."""
+    def __init__(self, logger=None, batch_size=OUTPUT_BATCH_SIZE):
+        self.logger = logger
+        self.batch_size = batch_size
+        self.messages = []
+
+    def add(self, level, msg):
+        self.messages.append((level, msg))
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+
+    def extend(self, messages):
+        for level, msg in messages:
+            self.add(level, msg)
+
+    def flush(self):
+        if not self.messages:
+            return
+        by_level = defaultdict(list)
+        for level, msg in self.messages:
+            by_level[level].append(msg)
+        self.messages = []
+        for level, lines in by_level.items():
+            print('\n'.join(lines), file=sys.stderr if level >= logging.WARNING else sys.stdout)
+            if self.logger and self.logger.isEnabledFor(level):
+                self.logger.log(level, '\n'.join(lines))
+
+class MoveJournal:
+    """Write-ahead journal of an --execute run: the plan, then a line per step done (see read_journal)."""
+    def __init__(self, journal_file, header=None, sync_every=JOURNAL_SYNC_EVERY):
+        self.sync_every = sync_every
+        self.unsynced = 0
+        self.lock = threading.Lock()
+        self.f = open(journal_file, 'w' if header is not None else 'a', encoding='utf-8')
+        if header is not None:
+            self.f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            self.sync()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                os.fsync(self.f.fileno())
+                self.unsynced = 0
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.f.close()
+
+def read_journal(journal_file):
+    """Load a move journal, or return None if there is none.
+
+    After the header line come {"dirs": [...]}, {"done": [group, step]},
+    {"undone": [group, step]} and {"complete": true} records. Returns a
+    dict with the plan's header, the (group, step) pairs done in the order
+    they completed, the set of those undone again, the directories created
+    and whether the run completed.
+    """
+    try:
+        f = open(journal_file, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    state = {'header': None, 'done': [], 'undone': set(), 'dirs': [], 'complete': False}
+    with f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash mid-write
+                continue
+            if state['header'] is None:
+                state['header'] = record
+            elif 'done' in record:
+                state['done'].append(tuple(record['done']))
+            elif 'undone' in record:
+                state['undone'].add(tuple(record['undone']))
+            elif 'dirs' in record:
+                state['dirs'].extend(record['dirs'])
+            elif record.get('complete'):
+                state['complete'] = True
+    if state['header'] is None:
+        return None
+    return state
+
+def create_directories(tree, dry_run, jobs, output, journal=None):
+    """Create every missing target directory once, before any file is moved."""
+    def create(rel_dir):
+        try:
+            os.makedirs(os.path.join(tree.base, rel_dir), exist_ok=True)
+            return logging.INFO, f"Created directory: {rel_dir}"
+        except OSError as e:
+            return logging.ERROR, f"Error creating directory {rel_dir}: {e}"
+
+    if dry_run:
+        for rel_dir in tree.missing_dirs:
+            output.add(logging.INFO, f"[DRY RUN] Would create directory: {rel_dir}")
+    else:
+        if journal and tree.missing_dirs:
+            # Parents makedirs creates along the way too, so a rollback removes them all
+            journal.write({'dirs': tree.missing_dirs + tree.missing_parents()})
+        # makedirs copes with two threads creating the same parent
+        output.extend(pool_map(create, tree.missing_dirs, jobs))
+    output.flush()
+
+def run_moves(tree, work, temp_paths, dry_run, jobs, output, journal=None, record='done'):
+    """Carry out planned steps and return (successful, failed, copied) counts.
+
+    work holds (group, [(step, (current_rel, target_rel, hash)), ...]) items.
+    Items run in a pool of `jobs` threads, the steps of each one in order.
+    Each step that completes is journaled as {record: [group, step]}.
+    """
+    def run_group(item):
+        # Returns (messages, successful, failed, copied) for one group of steps
+        g, steps = item
+        messages = []
+        successful = failed = copied = 0
+        for k, (current_rel, target_rel, file_hash) in steps:
+            if not tree.exists(current_rel):
+                messages.append((logging.WARNING, f"Warning: Source file not found: {current_rel}"))
+                failed += 1
+                continue
+            renamed = tree.same_device(current_rel, target_rel)
+            try:
+                if tree.exists(target_rel):
+                    if dry_run or not linked_both(tree.base, current_rel, target_rel):
+                        raise FileExistsError
+                    # Linked by a run that died before removing the source
+                    os.unlink(os.path.join(tree.base, current_rel))
+                    move_msg = f"Moved: {current_rel} -> {target_rel}"
+                elif dry_run:
+                    move_msg = f"[DRY RUN] Would move: {current_rel} -> {target_rel}"
+                else:
+                    move_file(os.path.join(tree.base, current_rel), os.path.join(tree.base, target_rel), renamed)
+                    move_msg = f"Moved: {current_rel} -> {target_rel}"
+            except FileExistsError:
+                messages.append((logging.WARNING, f"Warning: Target already exists, skipping: {target_rel}"))
+                failed += 1
+                continue
+            except (OSError, IOError) as e:
+                messages.append((logging.ERROR, f"Error moving {current_rel} to {target_rel}: {e}"))
+                failed += 1
+                continue
+            if journal:
+                journal.write({record: [g, k]})
+            if target_rel in temp_paths:
+                move_msg += " (temp name to break a cycle)"
+            if not renamed:
+                move_msg += " (copied across filesystems)"
+                copied += 1
+            messages.append((logging.INFO, move_msg))
+            tree.moved(current_rel, target_rel)
+            if target_rel not in temp_paths:
+                successful += 1
+        return messages, successful, failed, copied
+
+    successful_moves = 0
+    failed_moves = 0
+    copied_moves = 0
+    # A dry run makes no system calls here, so threads would only add overhead
+    for messages, successful, failed, copied in pool_map(run_group, work, 1 if dry_run else jobs):
+        output.extend(messages)
+        successful_moves += successful
+        failed_moves += failed
+        copied_moves += copied
+    output.flush()
+    return successful_moves, failed_moves, copied_moves
+
+def print_summary(lines, logger=None):
+    for line in [f"\n=== SUMMARY ==="] + lines:
+        print(line)
+        if logger:
+            logger.info(line.replace("=== ", "").replace(" ===", ""))
 
-def apply_moves(base_dir, current_map, target_map, dry_run=True, logger=None):
-    """Apply file moves based on hash mappings."""
+def apply_moves(base_dir, current_map, target_map, dry_run=True, logger=None, jobs=DEFAULT_JOBS, journal_file=None):
+    """Apply file moves based on hash mappings.
+
+    Moves that don't depend on each other run in a pool of `jobs` threads.
+    When executing with a journal_file, the plan and each completed move
+    are journaled there (see MoveJournal).
+    """
     base_path = Path(base_dir).resolve()
 
     if not base_path.exists():
@@ -70,83 +417,63 @@ def apply_moves(base_dir, current_map, target_map, dry_run=True, logger=None):
             logger.error(error_msg)
         return
 
-    # Invert maps for easier lookup
-    current_path_to_hash = invert_hash_map(current_map)
-    target_path_to_hash = invert_hash_map(target_map)
-
-    # Find what needs to be moved
+    # Find what needs to be moved, one hash at a time, in a single merged
+    # pass over both maps. Every copy of a file's content is matched, so
+    # duplicates are moved (or reported) too.
     moves_needed = []
-    files_to_keep = set()
-
-    for target_path, target_hash in target_path_to_hash.items():
-        if target_hash in current_map:
-            current_path = current_map[target_hash]
-            if current_path != target_path:
-                # File exists but in wrong location
-                moves_needed.append((current_path, target_path, target_hash))
-            files_to_keep.add(current_path)
+    missing_files = []
+    extra_files = []
+    current_files = 0
+    target_files = 0
+
+    for file_hash, current_entries, target_entries in hashmap.join_maps(current_map, target_map):
+        current_files += len(current_entries)
+        target_files += len(target_entries)
+        moves, missing, extra = match_paths(
+            [entry['path'] for entry in current_entries], [entry['path'] for entry in target_entries]
+        )
+        moves_needed.extend((current_path, target_path, file_hash) for current_path, target_path in moves)
+        missing_files.extend(missing)
+        extra_files.extend(extra)
+    print(f"Current map: {current_files} files")
+    print(f"Target map: {target_files} files")
+    if logger:
+        logger.info(f"Current map: {current_files} files")
+        logger.info(f"Target map: {target_files} files")
 
-    # Apply moves
+    # Apply moves, in an order where chains and swaps can complete
+    tree = TreeState(base_path, (path for move in moves_needed for path in move[:2]), jobs)
+    groups, temp_paths = plan_moves(moves_needed, tree.exists)
     mode_str = "[DRY RUN] " if dry_run else ""
     action_verb = "Would move" if dry_run else "Moving"
     print(f"{mode_str}{action_verb} {len(moves_needed)} files...")
+    if temp_paths:
+        print(f"{mode_str}{len(temp_paths)} move cycles are broken through temp names")
 
     if logger:
-        logger.info(f"{mode_str}Processing {len(moves_needed)} file moves")
-
-    successful_moves = 0
-    failed_moves = 0
-
-    for current_rel, target_rel, file_hash in moves_needed:
-        current_full = base_path / current_rel
-        target_full = base_path / target_rel
-
-        if not current_full.exists():
-            warning_msg = f"Warning: Source file not found: {current_rel}"
-            print(warning_msg, file=sys.stderr)
-            if logger:
-                logger.warning(warning_msg)
-            failed_moves += 1
-            continue
-
-        if target_full.exists():
-            warning_msg = f"Warning: Target already exists, skipping: {target_rel}"
-            print(warning_msg, file=sys.stderr)
-            if logger:
-                logger.warning(warning_msg)
-            failed_moves += 1
-            continue
-
-        try:
-            ensure_directory(target_full, dry_run, logger)
-
-            if dry_run:
-                move_msg = f"[DRY RUN] Would move: {current_rel} -> {target_rel}"
-                print(move_msg)
-                if logger:
-                    logger.info(move_msg)
-                successful_moves += 1
-            else:
-                shutil.move(str(current_full), str(target_full))
-                move_msg = f"Moved: {current_rel} -> {target_rel}"
-                print(move_msg)
-                if logger:
-                    logger.info(move_msg)
-                successful_moves += 1
-
-        except (OSError, IOError) as e:
-            error_msg = f"Error moving {current_rel} to {target_rel}: {e}"
-            print(error_msg, file=sys.stderr)
-            if logger:
-                logger.error(error_msg)
-            failed_moves += 1
+        logger.info(f"{mode_str}Processing {len(moves_needed)} file moves ({len(temp_paths)} cycles)")
+
+    journal = None
+    if journal_file and not dry_run:
+        journal = MoveJournal(journal_file, {
+            'base': str(base_path),
+            'groups': groups,
+            'temp_paths': sorted(temp_paths),
+            'missing': len(missing_files),
+            'extra': len(extra_files)
+        })
+    output = BatchedOutput(logger)
+    try:
+        create_directories(tree, dry_run, jobs, output, journal)
+        work = [(g, list(enumerate(steps))) for g, steps in enumerate(groups)]
+        successful_moves, failed_moves, copied_moves = run_moves(tree, work, temp_paths, dry_run, jobs, output, journal)
+        if journal:
+            journal.write({'complete': True})
+    finally:
+        if journal:
+            journal.close()
 
     # Report missing files (in target but not in current)
-    missing_files = []
-    for target_hash, target_path in target_map.items():
-        if target_hash not in current_map:
-            missing_files.append(target_path)
-
     if missing_files:
         print(f"\n=== MISSING FILES ({len(missing_files)}) ===")
         if logger:
@@ -157,11 +484,6 @@ def apply_moves(base_dir, current_map, target_map, dry_run=True, logger=None):
                 logger.info(f"Missing file: {missing}")
 
     # Report extra files (in current but not in target)
-    extra_files = []
-    for current_hash, current_path in current_map.items():
-        if current_hash not in target_map:
-            extra_files.append(current_path)
-
     if extra_files:
         print(f"\n=== EXTRA FILES ({len(extra_files)}) ===")
         if logger:
@@ -171,20 +493,162 @@ def apply_moves(base_dir, current_map, target_map, dry_run=True, logger=None):
             if logger:
                 logger.info(f"Extra file: {extra}")
 
-    # Summary
-    summary_lines = [
-        f"\n=== SUMMARY ===",
+    print_summary([
         f"Mode: {'DRY RUN' if dry_run else 'EXECUTE'}",
         f"Successful moves: {successful_moves}",
         f"Failed moves: {failed_moves}",
+        f"Cross-filesystem copies: {copied_moves}",
         f"Missing files: {len(missing_files)}",
         f"Extra files: {len(extra_files)}"
-    ]
+    ], logger)
 
-    for line in summary_lines:
-        print(line)
+def journal_base(state, base_dir):
+    """The resolved base_dir, or None (after reporting it) if the journal is for another tree."""
+    base_path = Path(base_dir).resolve()
+    if state['header']['base'] != str(base_path):
+        print(f"Error: The journal is for {state['header']['base']}, not {base_path}", file=sys.stderr)
+        return None
+    return base_path
+
+def in_flight_steps(state):
+    """(group, step, move) for the step of each group that may have been running when a run died.
+
+    That is the step after the group's last journaled one. A move that
+    completed just before the process died has no "done" line yet; the
+    caller treats it as done if its source is gone and its target is there.
+    """
+    if state['complete']:
+        return []
+    last_done = {}
+    for g, k in state['done']:
+        if (g, k) not in state['undone']:
+            last_done[g] = max(k, last_done.get(g, -1))
+    steps = []
+    for g, group in enumerate(state['header']['groups']):
+        k = last_done.get(g, -1) + 1
+        if k < len(group):
+            steps.append((g, k, group[k]))
+    return steps
+
+def resume_moves(base_dir, journal_file, state, logger=None, jobs=DEFAULT_JOBS):
+    """Finish the run journaled in journal_file, without planning it again.
+
+    Only the steps not journaled as done are looked at, so the directories
+    of finished moves are never listed again.
+    """
+    base_path = journal_base(state, base_dir)
+    if base_path is None:
+        return
+    header = state['header']
+    done = set(state['done']) - state['undone']
+    remaining = defaultdict(dict)
+    for g, steps in enumerate(header['groups']):
+        for k, step in enumerate(steps):
+            if (g, k) not in done:
+                remaining[g][k] = step
+    tree = TreeState(base_path, (path for steps in remaining.values() for step in steps.values() for path in step[:2]), jobs)
+
+    journal = MoveJournal(journal_file)
+    try:
+        for g, k, (current_rel, target_rel, file_hash) in in_flight_steps(state):
+            if not tree.exists(current_rel) and tree.exists(target_rel):
+                journal.write({'done': [g, k]})
+                del remaining[g][k]
+        work = [(g, sorted(steps.items())) for g, steps in sorted(remaining.items()) if steps]
+        remaining_steps = sum(len(steps) for g, steps in work)
+        total_steps = sum(len(steps) for steps in header['groups'])
+        print(f"Resuming: {total_steps - remaining_steps} of {total_steps} steps already done")
         if logger:
-            logger.info(line.replace("=== ", "").replace(" ===", ""))
+            logger.info(f"Resuming journaled run: {remaining_steps} of {total_steps} steps left")
+
+        output = BatchedOutput(logger)
+        create_directories(tree, False, jobs, output, journal)
+        successful_moves, failed_moves, copied_moves = run_moves(
+            tree, work, set(header['temp_paths']), False, jobs, output, journal
+        )
+        journal.write({'complete': True})
+    finally:
+        journal.close()
+
+    print_summary([
+        "Mode: EXECUTE (resumed)",
+        f"Successful moves: {successful_moves}",
+        f"Failed moves: {failed_moves}",
+        f"Cross-filesystem copies: {copied_moves}",
+        f"Missing files: {header['missing']}",
+        f"Extra files: {header['extra']}"
+    ], logger)
+
+def rollback_moves(base_dir, journal_file, state, dry_run=True, logger=None, jobs=DEFAULT_JOBS):
+    """Undo a journaled run, finished or not, by replaying its completed steps in reverse.
+
+    Nothing is planned or hashed: each group's done steps are moved back,
+    last first, then the directories the run created are removed if empty.
+    The journal is deleted once everything is back in place.
+    """
+    base_path = journal_base(state, base_dir)
+    if base_path is None:
+        return
+    header = state['header']
+    by_group = defaultdict(list)
+    for g, k in reversed(state['done']):
+        if (g, k) not in state['undone']:
+            current_rel, target_rel, file_hash = header['groups'][g][k]
+            by_group[g].append((k, (target_rel, current_rel, file_hash)))
+    in_flight = in_flight_steps(state)
+    tree = TreeState(
+        base_path,
+        [path for steps in by_group.values() for k, step in steps for path in step[:2]]
+        + [path for g, k, step in in_flight for path in step[:2]],
+        jobs
+    )
+    for g, k, (current_rel, target_rel, file_hash) in in_flight:
+        if not tree.exists(current_rel) and tree.exists(target_rel):
+            # Done but not journaled, and the latest step of its group, so it goes back first
+            by_group[g].insert(0, (k, (target_rel, current_rel, file_hash)))
+        elif tree.exists(target_rel) and linked_both(base_path, current_rel, target_rel):
+            # Stopped between link and unlink; dropping the new link undoes it
+            if dry_run:
+                print(f"[DRY RUN] Would remove the second link: {target_rel}")
+            else:
+                os.unlink(base_path / target_rel)
+                tree.removed(target_rel)
+    work = sorted(by_group.items())
+    mode_str = "[DRY RUN] " if dry_run else ""
+    print(f"{mode_str}Rolling back {sum(len(steps) for g, steps in work)} journaled steps...")
+
+    journal = None if dry_run else MoveJournal(journal_file)
+    output = BatchedOutput(logger)
+    try:
+        successful_moves, failed_moves, copied_moves = run_moves(
+            tree, work, set(header['temp_paths']), dry_run, jobs, output, journal, record='undone'
+        )
+    finally:
+        if journal:
+            journal.close()
+
+    # Deepest first, so parents are empty by the time they come up
+    for rel_dir in sorted(set(state['dirs']), reverse=True):
+        if dry_run:
+            output.add(logging.INFO, f"[DRY RUN] Would remove directory if empty: {rel_dir}")
+            continue
+        try:
+            os.rmdir(base_path / rel_dir)
+            output.add(logging.INFO, f"Removed directory: {rel_dir}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            output.add(logging.WARNING, f"Warning: Could not remove directory {rel_dir}: {e}")
+    output.flush()
+    if not dry_run and not failed_moves:
+        os.remove(journal_file)
+
+    print_summary([
+        f"Mode: {'DRY RUN' if dry_run else 'EXECUTE'} (rollback)",
+        f"Successful moves: {successful_moves}",
+        f"Failed moves: {failed_moves}",
+        f"Cross-filesystem copies: {copied_moves}"
+    ], logger)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -200,14 +664,20 @@ Examples:
 
   # Execute moves with logging
   python apply_moves.py /path/to/sync/folder current.json target.json --execute --log-file moves.log --verbose
+
+  # Rerunning an interrupted --execute resumes it from current.json.moves.journal
+  python apply_moves.py /path/to/sync/folder current.json target.json --execute
+
+  # Undo the journaled moves
+  python apply_moves.py /path/to/sync/folder current.json target.json --rollback --execute
         """)
 
     parser.add_argument('base_directory',
                         help='Base directory containing files to move')
     parser.add_argument('current_hash_map',
-                        help='JSON file with current file hash mappings')
+                        help='Hash map of the current files (JSON, SQLite or manifest, any version)')
     parser.add_argument('target_hash_map',
-                        help='JSON file with target file hash mappings (source of truth)')
+                        help='Hash map of the target layout, the source of truth (JSON, SQLite or manifest, any version)')
 
     # Mode selection (mutually exclusive)
     mode_group = parser.add_mutually_exclusive_group()
@@ -222,6 +692,16 @@ Examples:
     # Logging options
     parser.add_argument('--log-file',
                         help='Log actions to specified file (also logs to stdout)')
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        default=DEFAULT_JOBS,
+                        help=f'Number of moves to run in parallel (default: {DEFAULT_JOBS})')
+    parser.add_argument('--journal',
+                        help='Journal of an --execute run, used to resume it or roll it back '
+                             '(default: CURRENT_HASH_MAP.moves.journal)')
+    parser.add_argument('--rollback',
+                        action='store_true',
+                        help='Undo the moves recorded in the journal, last first (a dry run unless --execute)')
     parser.add_argument('--verbose', '-v',
                         action='store_true',
                         help='Enable verbose logging')
@@ -249,23 +729,38 @@ Examples:
     logger.info(f"Target hash map: {args.target_hash_map}")
     logger.info(f"Mode: {'DRY RUN' if dry_run else 'EXECUTE'}")
 
-    print("Loading hash maps...")
-    current_map = load_hash_map(args.current_hash_map)
-    target_map = load_hash_map(args.target_hash_map)
-
-    if not current_map or not target_map:
-        error_msg = "Error: Could not load hash maps"
+    journal_file = args.journal or f"{args.current_hash_map}.moves.journal"
+    state = read_journal(journal_file)
+    # An interrupted run is finished from its journal rather than planned again
+    resume = state is not None and not state['complete'] and not dry_run and not args.rollback
+    if args.rollback and state is None:
+        error_msg = f"Error: No journal to roll back in {journal_file}"
         print(error_msg, file=sys.stderr)
         logger.error(error_msg)
         sys.exit(1)
 
-    print(f"Current map: {len(current_map)} files")
-    print(f"Target map: {len(target_map)} files")
-    logger.info(f"Loaded current map: {len(current_map)} files")
-    logger.info(f"Loaded target map: {len(target_map)} files")
+    if not args.rollback and not resume:
+        if state and not state['complete']:
+            print(f"Note: {journal_file} holds an interrupted run, which --execute will resume")
+        print("Loading hash maps...")
+        current_map = load_hash_map(args.current_hash_map)
+        target_map = load_hash_map(args.target_hash_map)
+
+        if not current_map or not target_map:
+            error_msg = "Error: Could not load hash maps"
+            print(error_msg, file=sys.stderr)
+            logger.error(error_msg)
+            sys.exit(1)
 
     try:
-        apply_moves(args.base_directory, current_map, target_map, dry_run, logger)
+        if args.rollback:
+            rollback_moves(args.base_directory, journal_file, state, dry_run, logger, args.jobs)
+        elif resume:
+            print(f"Resuming the interrupted run journaled in {journal_file}")
+            logger.info(f"Resuming from journal: {journal_file}")
+            resume_moves(args.base_directory, journal_file, state, logger, args.jobs)
+        else:
+            apply_moves(args.base_directory, current_map, target_map, dry_run, logger, args.jobs, journal_file)
     except Exception as e:
         error_msg = f"Unexpected error during operation: {e}"
         print(error_msg, file=sys.stderr)
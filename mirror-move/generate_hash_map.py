@@ -1,45 +1,159 @@
 #!/usr/bin/env python3
+import argparse
 import hashlib
 import json
 import os
+import queue
 import sys
+import threading
 import time
 from pathlib import Path
 
-def calculate_file_hash(filepath, chunk_size=8192):
+# filehash.py lives at the top of the repo, shared with dedup.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from filehash import hash_file, format_duration, ordered_pool_map, DEFAULT_BUFFER_SIZE
+from hashmap import load_hash_map, save_hash_map
+
+def calculate_file_hash(filepath, chunk_size=DEFAULT_BUFFER_SIZE):
     """Calculate SHA256 hash of file contents."""
-    sha256_hash = hashlib.sha256()
     try:
-        with open(filepath, 'rb') as f:
-            while chunk := f.read(chunk_size):
-                sha256_hash.update(chunk)
-        return sha256_hash.hexdigest()
+        return hash_file(filepath, hashlib.sha256, chunk_size).hexdigest()
     except (OSError, IOError) as e:
         print(f"Error reading {filepath}: {e}", file=sys.stderr)
         return None
 
-def generate_hash_map(base_dir, output_file):
-    """Generate mapping of file hash -> {relative path, updated time}. Only scan files whose mtime has changed."""
-    base_path = Path(base_dir).resolve()
+def build_path_index(hash_map):
+    """Index a loaded hash map by path: {path: (hash, entry)}.
+
+    If stale entries leave a path under more than one hash, the one seen
+    last wins.
+    """
+    return {entry['path']: (file_hash, entry) for file_hash, entries in hash_map.items() for entry in entries}
+
+def is_unchanged(indexed, stat):
+    """True if a path index value still describes a file with this stat result."""
+    if indexed is None:
+        return False
+    file_hash, entry = indexed
+    if entry.get('updated') != int(stat.st_mtime):
+        return False
+    # Older maps only have whole-second mtimes and no size
+    return entry.get('size') in (None, stat.st_size) and entry.get('mtime_ns') in (None, stat.st_mtime_ns)
+
+def group_by_hash(files):
+    """Turn {path: (hash, entry)} into the map's {hash: [entry, ...]}, entries sorted by path."""
     hash_map = {}
-    prev_map = {}
+    for path in sorted(files):
+        file_hash, entry = files[path]
+        hash_map.setdefault(file_hash, []).append(entry)
+    return hash_map
+
+def replay_journal(files, journal_file):
+    """Apply the entries journaled by an interrupted run to {path: (hash, entry)}. Returns how many were applied."""
+    applied = 0
+    try:
+        with open(journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    file_hash = entry.pop('hash')
+                    path = entry['path']
+                except (ValueError, KeyError, AttributeError):
+                    # A torn last line from a crash mid-write
+                    continue
+                files[path] = (file_hash, entry)
+                applied += 1
+    except FileNotFoundError:
+        pass
+    return applied
+
+def hash_map_writer(files, output_file, results, checkpoint_files=10000, checkpoint_seconds=300.0):
+    """Writer thread: the only code touching files and output_file during a scan.
+
+    Takes (file_hash, rel_path_str, stat) results off the queue until it
+    gets None. Each result is stored in files, the {path: (hash, entry)}
+    dict the map is built from, and appended as one line
+    to output_file + ".journal", which is cheap however big the map gets.
+    The full map is only rewritten (compacted) every checkpoint_files
+    results or checkpoint_seconds, and at the end, when the journal is
+    truncated or removed. A crashed run's journal is replayed by the next.
+    """
+    journal_file = f"{output_file}.journal"
+    unsaved = 0
+    last_checkpoint = time.monotonic()
+    done = False
+    with open(journal_file, 'a', encoding='utf-8') as journal:
+        while not done:
+            batch = [results.get()]
+            while True:
+                try:
+                    batch.append(results.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    done = True
+                    continue
+                file_hash, rel_path_str, stat = item
+                entry = {
+                    'path': rel_path_str,
+                    'updated': int(stat.st_mtime),
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns
+                }
+                files[rel_path_str] = (file_hash, entry)
+                journal.write(json.dumps({'hash': file_hash, **entry}, ensure_ascii=False) + '\n')
+                unsaved += 1
+            try:
+                journal.flush()
+                if done or unsaved >= checkpoint_files or time.monotonic() - last_checkpoint >= checkpoint_seconds:
+                    save_hash_map(group_by_hash(files), output_file)
+                    # Everything journaled so far is in the map now
+                    journal.truncate(0)
+                    unsaved = 0
+                    last_checkpoint = time.monotonic()
+            except IOError as e:
+                print(f"Error writing to {output_file}: {e}", file=sys.stderr)
+    if not unsaved:
+        os.remove(journal_file)
+
+def generate_hash_map(base_dir, output_file, jobs=1, checkpoint_files=10000, checkpoint_seconds=300.0):
+    """Generate mapping of file hash -> [{relative path, updated time, size, mtime_ns}, ...]. Only scan files whose size or mtime has changed.
+
+    The map is written in the format described in hashmap.py: version 2
+    JSON, SQLite if output_file ends in .db/.sqlite/.sqlite3, or a manifest
+    if it ends in .manifest. Any older map at output_file is read and
+    upgraded. Files that are no longer on disk are dropped from the map.
+
+    With jobs > 1, files are hashed by that many threads. New entries are
+    journaled and the map is rewritten at checkpoints, see hash_map_writer.
+    """
+    base_path = Path(base_dir).resolve()
+    prev_by_path = {}
 
     # Load previous hash map if output file exists
     if Path(output_file).exists():
         try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                prev_map = json.load(f)
-                hash_map = prev_map.copy()
+            prev_map = load_hash_map(output_file)
+            prev_by_path = build_path_index(prev_map)
+            prev_map.close()
         except Exception as e:
             print(f"Warning: Could not load previous hash map: {e}", file=sys.stderr)
 
+    # Pick up files hashed by a run that didn't get to its final checkpoint
+    replayed = replay_journal(prev_by_path, f"{output_file}.journal")
+    if replayed:
+        print(f"Replayed {replayed} journal entries from an interrupted run")
+
     if not base_path.exists():
         print(f"Error: Directory {base_dir} does not exist", file=sys.stderr)
         return {}
 
     print(f"Scanning directory: {base_path}")
 
-    # Pre-scan to count files to be scanned
+    # Pre-scan to count files to be scanned. Unchanged files keep their
+    # entry; anything not found on disk is left behind with prev_by_path.
+    entries_by_path = {}
     files_to_scan = []
     for root, dirs, files in os.walk(base_path):
         for file in files:
@@ -47,61 +161,63 @@ def generate_hash_map(base_dir, output_file):
             try:
                 rel_path = filepath.relative_to(base_path)
                 rel_path_str = str(rel_path).replace('\\', '/')
-                mtime = int(filepath.stat().st_mtime)
-                key_value = next(((k, v) for (k, v) in prev_map.items() if v['path'] == rel_path_str), None)
-                k, v = key_value if key_value else (None, None)
-                if not (k and v['updated'] == mtime):
-                    files_to_scan.append((filepath, rel_path_str, mtime))
+                stat = filepath.stat()
+                indexed = prev_by_path.get(rel_path_str)
+                if is_unchanged(indexed, stat):
+                    entries_by_path[rel_path_str] = indexed
+                else:
+                    files_to_scan.append((filepath, rel_path_str, stat))
             except Exception:
                 continue
+    del prev_by_path
     total_files = len(files_to_scan)
-    print(f"Total files to scan: {total_files}")
+    total_bytes = sum(stat.st_size for filepath, rel_path_str, stat in files_to_scan)
+    print(f"Total files to scan: {total_files} ({total_bytes / 1e6:.1f} MB)")
+
+    # From here on entries_by_path belongs to the writer thread
+    results = queue.Queue()
+    writer = threading.Thread(
+        target=hash_map_writer,
+        args=(entries_by_path, output_file, results, checkpoint_files, checkpoint_seconds)
+    )
+    writer.start()
 
     file_count = 0
+    done_bytes = 0
     start_time = time.time()
-    scan_times = []
-    for idx, (filepath, rel_path_str, mtime) in enumerate(files_to_scan, 1):
-        try:
-            print(f"Scanning: {rel_path_str}...", file=sys.stderr, end=' ')
-            t0 = time.time()
-            file_hash = calculate_file_hash(filepath)
-            t1 = time.time()
-            scan_times.append(t1 - t0)
-
-            print("Done!", file=sys.stderr)
-
+    try:
+        hashed = ordered_pool_map(lambda item: calculate_file_hash(item[0]), files_to_scan, jobs)
+        for idx, ((filepath, rel_path_str, stat), file_hash) in enumerate(zip(files_to_scan, hashed), 1):
+            done_bytes += stat.st_size
             if file_hash:
-                hash_map[file_hash] = {'path': rel_path_str, 'updated': mtime}
+                results.put((file_hash, rel_path_str, stat))
                 file_count += 1
-
-                print(f"  Hash: {file_hash}", file=sys.stderr)
-
-                # Write output file after each file
-                try:
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(hash_map, f, indent=2, ensure_ascii=False)
-                except IOError as e:
-                    print(f"Error writing to {output_file}: {e}", file=sys.stderr)
-            # Status indicator
+                print(f"Done: {rel_path_str}\n  Hash: {file_hash}", file=sys.stderr)
+            # Status indicator: ETA from the bytes still to read at the rate so far
             elapsed = time.time() - start_time
-            avg_time = sum(scan_times) / len(scan_times) if scan_times else 0
-            remaining = total_files - idx
-            est_remaining = avg_time * remaining
-            est_total = elapsed + est_remaining
+            rate = done_bytes / elapsed if elapsed > 0 else 0
+            est_remaining = (total_bytes - done_bytes) / rate if rate else 0
             est_finish = time.strftime('%H:%M:%S', time.localtime(time.time() + est_remaining))
-            print(f"Status: {file_count}/{total_files} files processed | Elapsed: {elapsed:.1f}s | Avg: {avg_time:.2f}s/file | Time Remaining: {est_remaining} | Est Total: {est_total} | ETA: {est_finish}", file=sys.stderr)
-        except (OSError, ValueError) as e:
-            print(f"Error processing {filepath}: {e}", file=sys.stderr)
+            print(f"Status: {file_count}/{total_files} files processed ({idx - file_count} failed) | {done_bytes / 1e6:.1f}/{total_bytes / 1e6:.1f} MB | Elapsed: {format_duration(elapsed)} | {rate / 1e6:.1f} MB/s | Time Remaining: {format_duration(est_remaining)} | ETA: {est_finish}", file=sys.stderr)
+    finally:
+        results.put(None)
+        writer.join()
 
     print(f"Completed: {file_count} files processed", file=sys.stderr)
-    return hash_map
+    return group_by_hash(entries_by_path)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python generate_hash_map.py <base_directory> <output_json>")
-        sys.exit(1)
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a file hash -> [{path, updated, size, mtime_ns}] map of a directory tree, rehashing only changed files."
+    )
+    parser.add_argument("base_directory", help="Directory to scan")
+    parser.add_argument("output_json", help="Hash map to create or update (SQLite if it ends in .db, .sqlite or .sqlite3, a sorted manifest for .manifest)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files to hash in parallel (default: 1)")
+    parser.add_argument("--checkpoint-files", type=int, default=10000, help="Rewrite the output map after this many new hashes (default: 10000)")
+    parser.add_argument("--checkpoint-seconds", type=float, default=300.0, help="Rewrite the output map at least this often in seconds (default: 300)")
+    args = parser.parse_args()
 
-    base_dir = sys.argv[1]
-    output_file = sys.argv[2]
+    generate_hash_map(args.base_directory, args.output_json, args.jobs, args.checkpoint_files, args.checkpoint_seconds)
 
-    generate_hash_map(base_dir, output_file)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+r"""Hash map files shared by generate_hash_map.py and apply_moves.py.
+
+Format version 2 maps each content hash to a list of entries, one per file
+with that content, so identical files no longer overwrite each other:
+
+    {"version": 2, "files": {"<sha256>": [{"path": "a/b.txt", "updated": 1700000000,
+                                           "size": 123, "mtime_ns": 1700000000123456789}]}}
+
+Older maps are still read, giving one entry per hash: version 1
+({hash: {"path", "updated", ...}}, written by earlier generate_hash_map.py)
+and plain {hash: path}.
+
+For large trees the same data can be kept in SQLite instead: one row per
+file, the hash stored as a 32-byte blob and indexed (paths are unique but
+not indexed, which would store each one twice). Maps are written that
+way when their name ends in .db, .sqlite or .sqlite3, and SQLite files are
+recognised by their header when loading. A SQLite map is queried on demand
+rather than loaded into memory.
+
+The third format is a manifest, used for names ending in .manifest: a
+header line, then one line per file, sorted by hash and then path:
+
+    <sha256>\t<size>\t<mtime_ns>\t<path>
+
+with backslash, tab, CR and newline in paths escaped as \\, \t, \r and \n.
+Being sorted, two manifests can be compared by reading both front to back
+once (join_maps), in memory that doesn't grow with the tree. Lookups of a
+single hash binary-search the file.
+
+All kinds of map offer the same lookups: len(m), hash in m, m.entries(hash)
+and m.items(), which yields (hash, [entry, ...]) in hash order.
+"""
+import json
+import os
+import sqlite3
+from itertools import groupby
+
+FORMAT_VERSION = 2
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+SQLITE_MAGIC = b'SQLite format 3\x00'
+MANIFEST_SUFFIXES = ('.manifest',)
+MANIFEST_HEADER = '# mirror-move manifest 1\n'
+
+SCHEMA = """
+CREATE TABLE files (
+    path TEXT NOT NULL,
+    hash BLOB NOT NULL,
+    updated INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX files_hash ON files (hash);
+"""
+ENTRY_FIELDS = ('path', 'updated', 'size', 'mtime_ns')
+
+class JsonHashMap:
+    """A hash map held in memory as {hash: [entry, ...]}."""
+    def __init__(self, files):
+        self.files = files
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.files.values())
+
+    def __contains__(self, file_hash):
+        return file_hash in self.files
+
+    def entries(self, file_hash):
+        return self.files.get(file_hash, [])
+
+    def items(self):
+        for file_hash in sorted(self.files):
+            yield file_hash, self.files[file_hash]
+
+    def close(self):
+        pass
+
+class SqliteHashMap:
+    """A hash map in a SQLite file, opened read-only."""
+    def __init__(self, map_file):
+        self.conn = sqlite3.connect(f"file:{map_file}?mode=ro", uri=True)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def __contains__(self, file_hash):
+        row = self.conn.execute("SELECT 1 FROM files WHERE hash = ? LIMIT 1", (bytes.fromhex(file_hash),))
+        return row.fetchone() is not None
+
+    def entries(self, file_hash):
+        rows = self.conn.execute(
+            "SELECT path, updated, size, mtime_ns FROM files WHERE hash = ? ORDER BY path",
+            (bytes.fromhex(file_hash),)
+        )
+        return [dict(zip(ENTRY_FIELDS, row)) for row in rows]
+
+    def items(self):
+        rows = self.conn.execute("SELECT hash, path, updated, size, mtime_ns FROM files ORDER BY hash, path")
+        for file_hash, group in groupby(rows, key=lambda row: row[0]):
+            yield file_hash.hex(), [dict(zip(ENTRY_FIELDS, row[1:])) for row in group]
+
+    def close(self):
+        self.conn.close()
+
+MANIFEST_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\r': '\\r', '\n': '\\n'}
+MANIFEST_UNESCAPES = {'\\': '\\', 't': '\t', 'r': '\r', 'n': '\n'}
+
+def escape_path(path):
+    if '\\' in path or '\t' in path or '\r' in path or '\n' in path:
+        return ''.join(MANIFEST_ESCAPES.get(c, c) for c in path)
+    return path
+
+def unescape_path(path):
+    if '\\' not in path:
+        return path
+    chars = iter(path)
+    return ''.join(MANIFEST_UNESCAPES[next(chars)] if c == '\\' else c for c in chars)
+
+def manifest_entry(size, mtime_ns, path):
+    mtime_ns = int(mtime_ns) if mtime_ns else None
+    return {
+        'path': unescape_path(path),
+        'updated': mtime_ns // 1_000_000_000 if mtime_ns is not None else None,
+        'size': int(size) if size else None,
+        'mtime_ns': mtime_ns
+    }
+
+class ManifestHashMap:
+    """A hash map in a manifest file, read from disk as needed."""
+    def __init__(self, map_file):
+        self.map_file = map_file
+        self.size = os.path.getsize(map_file)
+        self.data_start = len(MANIFEST_HEADER.encode('utf-8'))
+        self.count = None
+
+    def __bool__(self):
+        # Without reading the file, as __len__ would
+        return self.size > self.data_start
+
+    def __len__(self):
+        if self.count is None:
+            with open(self.map_file, 'rb') as f:
+                self.count = sum(1 for line in f) - 1
+        return self.count
+
+    def __contains__(self, file_hash):
+        return bool(self.entries(file_hash))
+
+    def _line_after(self, f, pos):
+        # Offset of the first line starting at or after pos
+        if pos <= self.data_start:
+            return self.data_start
+        f.seek(pos - 1)
+        f.readline()
+        return f.tell()
+
+    def entries(self, file_hash):
+        key = file_hash.encode('ascii') + b'\t'
+        with open(self.map_file, 'rb') as f:
+            # Binary search for the first line whose hash is >= file_hash
+            lo, hi = self.data_start, self.size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                f.seek(self._line_after(f, mid))
+                line = f.readline()
+                if not line or line >= key:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            f.seek(self._line_after(f, lo))
+            entries = []
+            for line in f:
+                if not line.startswith(key):
+                    break
+                entries.append(manifest_entry(*line.decode('utf-8').rstrip('\n').split('\t')[1:]))
+            return entries
+
+    def items(self):
+        with open(self.map_file, 'r', encoding='utf-8', newline='\n') as f:
+            f.readline()
+            file_hash = None
+            entries = []
+            for line in f:
+                line_hash, size, mtime_ns, path = line.rstrip('\n').split('\t')
+                if line_hash != file_hash:
+                    if entries:
+                        yield file_hash, entries
+                    if file_hash is not None and line_hash < file_hash:
+                        raise ValueError(f"{self.map_file} is not sorted by hash")
+                    file_hash = line_hash
+                    entries = []
+                entries.append(manifest_entry(size, mtime_ns, path))
+            if entries:
+                yield file_hash, entries
+
+    def close(self):
+        pass
+
+def join_maps(current_map, target_map):
+    """Yield (hash, current_entries, target_entries) for every hash in either map.
+
+    A merge of the two maps' items(), which come in hash order, so each map
+    is read once and only one hash's entries from each are held at a time.
+    A hash missing from one map gets [] for it.
+    """
+    current = iter(current_map.items())
+    target = iter(target_map.items())
+    c = next(current, None)
+    t = next(target, None)
+    while c is not None or t is not None:
+        if t is None or (c is not None and c[0] < t[0]):
+            yield c[0], c[1], []
+            c = next(current, None)
+        elif c is None or t[0] < c[0]:
+            yield t[0], [], t[1]
+            t = next(target, None)
+        else:
+            yield c[0], c[1], t[1]
+            c = next(current, None)
+            t = next(target, None)
+
+def is_sqlite_file(map_file):
+    with open(map_file, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+def from_json(data):
+    """Normalise a loaded JSON map of any version to {hash: [entry, ...]}."""
+    if 'version' in data:
+        if data['version'] != FORMAT_VERSION:
+            raise ValueError(f"unsupported hash map version {data['version']}")
+        return data['files']
+    files = {}
+    for file_hash, value in data.items():
+        # Version 1 entries are dicts, the oldest maps have bare paths
+        files[file_hash] = [dict(value) if isinstance(value, dict) else {'path': value}]
+    return files
+
+def is_manifest_file(map_file):
+    header = MANIFEST_HEADER.encode('utf-8')
+    with open(map_file, 'rb') as f:
+        return f.read(len(header)) == header
+
+def load_hash_map(map_file):
+    """Open a hash map in any supported format. Raises OSError, ValueError or sqlite3.Error."""
+    if is_sqlite_file(map_file):
+        return SqliteHashMap(map_file)
+    if is_manifest_file(map_file):
+        return ManifestHashMap(map_file)
+    with open(map_file, 'r', encoding='utf-8') as f:
+        return JsonHashMap(from_json(json.load(f)))
+
+def save_hash_map(files, map_file):
+    """Write {hash: [entry, ...]} to map_file through a temp file and a rename.
+
+    SQLite is used for names ending in SQLITE_SUFFIXES, a manifest for
+    MANIFEST_SUFFIXES, else version 2 JSON.
+    """
+    tmp_file = f"{map_file}.tmp"
+    if map_file.endswith(MANIFEST_SUFFIXES):
+        with open(tmp_file, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(MANIFEST_HEADER)
+            for file_hash in sorted(files):
+                for entry in sorted(files[file_hash], key=lambda entry: entry['path']):
+                    size = entry.get('size')
+                    mtime_ns = entry.get('mtime_ns')
+                    f.write(f"{file_hash}\t{'' if size is None else size}\t{'' if mtime_ns is None else mtime_ns}\t{escape_path(entry['path'])}\n")
+    elif map_file.endswith(SQLITE_SUFFIXES):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        conn = sqlite3.connect(tmp_file)
+        try:
+            conn.executescript(SCHEMA)
+            with conn:
+                conn.executemany(
+                    "INSERT INTO files (path, hash, updated, size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (entry['path'], bytes.fromhex(file_hash), entry.get('updated'), entry.get('size'), entry.get('mtime_ns'))
+                        for file_hash, entries in files.items() for entry in entries
+                    )
+                )
+        finally:
+            conn.close()
+    else:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': FORMAT_VERSION, 'files': files}, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_file, map_file)
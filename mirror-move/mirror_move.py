@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Mirror a target layout onto a local tree in one pass, without a map of the local tree.
+
+    python mirror_move.py /path/to/sync/folder target.json [--execute]
+
+The target hash map (any format, see hashmap.py) is read and the local tree
+is walked once. A file at a target path with the target's size and mtime
+(to the nanosecond) is taken to be in place and never read. Any other
+file is hashed only if some target entry still waiting for a file has its
+size, and as soon as its hash matches one it is moved there, if that path
+is free. Moves onto paths still taken by other files are planned and run
+at the end, as apply_moves.py does, so chains and swaps complete.
+
+On a tree that is already mostly in sync, with mtimes kept by whatever
+copied it, only the few files that moved are read. Target entries from
+maps without sizes or mtime_ns (version 0 and 1) can't be matched that
+way: every file at one of their paths is hashed, and while any of them
+are waiting so is every file that isn't in place.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+from apply_moves import (
+    DEFAULT_JOBS, BatchedOutput, TreeState, create_directories, load_hash_map,
+    move_file, plan_moves, print_summary, run_moves
+)
+from generate_hash_map import calculate_file_hash, format_duration, ordered_pool_map
+
+class TargetIndex:
+    """The target entries still waiting for a file, by path, hash and size."""
+    def __init__(self, target_map):
+        self.by_path = {}
+        self.waiting = {}
+        self.sizes = {}
+        for file_hash, entries in target_map.items():
+            for entry in entries:
+                self.by_path[entry['path']] = (file_hash, entry.get('size'), entry.get('mtime_ns'))
+                self.waiting.setdefault(file_hash, set()).add(entry['path'])
+                self.sizes[entry.get('size')] = self.sizes.get(entry.get('size'), 0) + 1
+
+    def wants_size(self, size):
+        return self.sizes.get(size, 0) > 0 or self.sizes.get(None, 0) > 0
+
+    def in_place(self, rel, stat):
+        """True if rel is a target path and the file there has the target's size and mtime."""
+        target = self.by_path.get(rel)
+        return target is not None and target[1] == stat.st_size and target[2] == stat.st_mtime_ns
+
+    def in_place_by_hash(self, rel, file_hash):
+        """True if rel is a target path still waiting for a file with this hash."""
+        target = self.by_path.get(rel)
+        return target is not None and target[0] == file_hash and rel in self.waiting[file_hash]
+
+    def satisfy(self, rel):
+        file_hash, size, mtime_ns = self.by_path[rel]
+        paths = self.waiting.get(file_hash)
+        if paths is not None and rel in paths:
+            paths.remove(rel)
+            self.sizes[size] -= 1
+
+    def waiting_paths(self, file_hash):
+        return sorted(self.waiting.get(file_hash, ()))
+
+def walk_files(base_path):
+    """Yield (rel_path, stat) for every file under base_path."""
+    for root, dirs, files in os.walk(base_path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            try:
+                stat = os.stat(full)
+            except OSError:
+                continue
+            yield os.path.relpath(full, base_path).replace('\\', '/'), stat
+
+def mirror(base_dir, target_file, dry_run=True, jobs=DEFAULT_JOBS):
+    """Rearrange base_dir to match the target hash map in target_file (see the module docstring).
+
+    Candidate files are hashed in a pool of `jobs` threads while the walk
+    goes on, and moves that end up waiting for a path run in the same
+    parallel executor as apply_moves.py.
+    """
+    base_path = Path(base_dir).resolve()
+    if not base_path.exists():
+        print(f"Error: Base directory {base_dir} does not exist", file=sys.stderr)
+        return
+    target_map = load_hash_map(target_file)
+    if not target_map:
+        print("Error: Could not load the target hash map", file=sys.stderr)
+        sys.exit(1)
+    targets = TargetIndex(target_map)
+    print(f"Target map: {len(targets.by_path)} files")
+
+    output = BatchedOutput()
+    mode_str = "[DRY RUN] " if dry_run else ""
+    in_place = 0
+    hashed_files = 0
+    hashed_bytes = 0
+    total_files = 0
+    total_bytes = 0
+    extra_files = []
+    deferred = []
+    moved = []
+    copied_early = 0
+    # Target paths filled, and paths emptied by moves (or that would be, on a dry run)
+    claimed = set()
+    vacated = set()
+    created_dirs = set()
+    dir_devices = {}
+    start_time = time.time()
+
+    def candidates():
+        nonlocal in_place, total_files, total_bytes
+        for rel, stat in walk_files(base_path):
+            if rel in claimed:
+                # Moved here earlier in this walk
+                continue
+            total_files += 1
+            total_bytes += stat.st_size
+            if targets.in_place(rel, stat):
+                targets.satisfy(rel)
+                claimed.add(rel)
+                in_place += 1
+            elif targets.wants_size(stat.st_size):
+                yield rel, stat
+            else:
+                extra_files.append(rel)
+
+    def free_target(file_hash):
+        # A waiting target path for file_hash that nothing occupies now, or None
+        for target_rel in targets.waiting_paths(file_hash):
+            if target_rel in vacated or not (base_path / target_rel).exists():
+                return target_rel
+        return None
+
+    def device(rel_dir):
+        # The device rel_dir is on, or will be on once created
+        if rel_dir not in dir_devices:
+            try:
+                dir_devices[rel_dir] = os.stat(base_path / rel_dir).st_dev
+            except FileNotFoundError:
+                dir_devices[rel_dir] = device(os.path.dirname(rel_dir))
+        return dir_devices[rel_dir]
+
+    hashed = ordered_pool_map(lambda item: (item, calculate_file_hash(base_path / item[0])), candidates(), jobs)
+    for (rel, stat), file_hash in hashed:
+        hashed_files += 1
+        hashed_bytes += stat.st_size
+        if not file_hash or not targets.waiting.get(file_hash):
+            extra_files.append(rel)
+            continue
+        if targets.in_place_by_hash(rel, file_hash):
+            # At its target path, but its size and mtime didn't match the map's
+            targets.satisfy(rel)
+            claimed.add(rel)
+            in_place += 1
+            continue
+        target_rel = free_target(file_hash)
+        if target_rel is None:
+            # Its targets are all taken for now; maybe by files still to be moved away
+            deferred.append((rel, file_hash))
+            continue
+        target_full = base_path / target_rel
+        target_dir = os.path.dirname(target_rel)
+        try:
+            if target_dir not in created_dirs and not target_full.parent.exists():
+                if not dry_run:
+                    target_full.parent.mkdir(parents=True, exist_ok=True)
+                output.add(logging.INFO, f"{mode_str}{'Would create' if dry_run else 'Created'} directory: {target_dir}")
+                created_dirs.add(target_dir)
+            renamed = stat.st_dev == device(target_dir)
+            if not dry_run:
+                move_file(base_path / rel, target_full, renamed)
+        except OSError as e:
+            output.add(logging.ERROR, f"Error moving {rel} to {target_rel}: {e}")
+            extra_files.append(rel)
+            continue
+        move_msg = f"{mode_str}{'Would move' if dry_run else 'Moved'}: {rel} -> {target_rel}"
+        if not renamed:
+            move_msg += " (copied across filesystems)"
+            copied_early += 1
+        output.add(logging.INFO, move_msg)
+        moved.append((rel, target_rel))
+        vacated.add(rel)
+        vacated.discard(target_rel)
+        targets.satisfy(target_rel)
+        claimed.add(target_rel)
+    output.flush()
+    elapsed = time.time() - start_time
+    print(f"Walked {total_files} files ({total_bytes / 1e6:.1f} MB), hashed {hashed_files} ({hashed_bytes / 1e6:.1f} MB) in {format_duration(elapsed)}")
+
+    # Files whose targets were taken when they were hashed: hand out the
+    # targets still waiting and plan the moves, so chains and swaps complete
+    moves = []
+    for rel, file_hash in deferred:
+        waiting = targets.waiting_paths(file_hash)
+        if not waiting:
+            extra_files.append(rel)
+            continue
+        moves.append((rel, waiting[0], file_hash))
+        targets.satisfy(waiting[0])
+        claimed.add(waiting[0])
+    successful = failed = copied = 0
+    if moves:
+        paths = [path for move in moves for path in move[:2]]
+        if dry_run:
+            # The tree on disk doesn't show the moves a dry run only printed
+            paths += [path for move in moved for path in move]
+        tree = TreeState(base_path, paths, jobs)
+        if dry_run:
+            for rel, target_rel in moved:
+                tree.moved(rel, target_rel)
+            tree.missing_dirs = [rel_dir for rel_dir in tree.missing_dirs if rel_dir not in created_dirs]
+        groups, temp_paths = plan_moves(moves, tree.exists)
+        print(f"{mode_str}{'Would move' if dry_run else 'Moving'} {len(moves)} files onto paths other files were using...")
+        create_directories(tree, dry_run, jobs, output)
+        work = [(g, list(enumerate(steps))) for g, steps in enumerate(groups)]
+        successful, failed, copied = run_moves(tree, work, temp_paths, dry_run, jobs, output)
+
+    missing_files = sorted(path for paths in targets.waiting.values() for path in paths)
+    if missing_files:
+        print(f"\n=== MISSING FILES ({len(missing_files)}) ===")
+        print("\n".join(f"Missing: {missing}" for missing in missing_files))
+    if extra_files:
+        print(f"\n=== EXTRA FILES ({len(extra_files)}) ===")
+        print("\n".join(f"Extra: {extra}" for extra in sorted(extra_files)))
+
+    print_summary([
+        f"Mode: {'DRY RUN' if dry_run else 'EXECUTE'}",
+        f"Already in place: {in_place}",
+        f"Successful moves: {len(moved) + successful}",
+        f"Failed moves: {failed}",
+        f"Cross-filesystem copies: {copied_early + copied}",
+        f"Files hashed: {hashed_files} ({hashed_bytes / 1e6:.1f} of {total_bytes / 1e6:.1f} MB)",
+        f"Missing files: {len(missing_files)}",
+        f"Extra files: {len(extra_files)}"
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move files in a local tree into a target layout, walking the tree directly instead of through a hash map of it"
+    )
+    parser.add_argument('base_directory', help='Directory to rearrange')
+    parser.add_argument('target_hash_map', help='Hash map of the target layout (JSON, SQLite or manifest, any version)')
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument('--dry-run', action='store_true', default=True, help='Show what would be moved without moving anything (default)')
+    mode_group.add_argument('--execute', action='store_true', help='Actually move the files')
+    parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS, help=f'Number of files to hash, and moves to run, in parallel (default: {DEFAULT_JOBS})')
+    args = parser.parse_args()
+
+    if args.execute:
+        print("=== EXECUTE MODE (files will actually be moved) ===")
+    else:
+        print("=== DRY RUN MODE (use --execute to actually move files) ===")
+    mirror(args.base_directory, args.target_hash_map, not args.execute, args.jobs)
+
+if __name__ == "__main__":
+    main()